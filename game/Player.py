@@ -53,7 +53,6 @@ class Player(pygame.sprite.Sprite):
     def check_collision(self, relative):
         if relative[0] < 0 or relative[1] < 0 or relative[0] >= \
                 self.maze.shape[0] or relative[1] >= self.maze.shape[1] or \
-                self.maze[relative[0]][
-                    relative[1]] == 1:
+                self.maze[relative[0], relative[1]] == 1:
             return True
         return False
@@ -1,11 +1,11 @@
 import jwt
+import numpy as np
 import pygame
 import pygame_gui
 
 from game.Player import Player
-from networking import config, tlv_definitions
+from networking import config
 from networking.client.client import Client
-from networking.tlv_parser import TLVParser
 from threading import Lock
 
 
@@ -22,6 +22,10 @@ class Game:
         self.clock = pygame.time.Clock()
         self.state = "MAIN_MENU"
         self.username = ''
+        self.maze_surface = None
+        self.maze_surface_map = None
+        self.position_sequence = None
+        self.position_snapshots = {}
 
     def main_menu(self):
         self.ui_manager = pygame_gui.UIManager((800, 579))
@@ -287,6 +291,8 @@ class Game:
             time_delta = self.clock.tick(60) / 1000.0
             self.render()
 
+            # Key presses of a frame are sent together
+            moves = []
             for event in pygame.event.get():
                 if event.type == pygame.KEYDOWN:
                     print(event.type)
@@ -305,7 +311,10 @@ class Game:
                             direction = "RIGHT"
 
                         if direction:
-                            self.client.send_move_request(self.username, self.jwt_token, direction, self.room_id)
+                            moves.append((direction, pygame.time.get_ticks()))
+            if moves:
+                self.client.send_move_batch_request(self.username, self.jwt_token, moves, self.room_id,
+                                                    self.position_sequence)
             pygame.display.update()
             self.clock.tick(60)
 
@@ -318,18 +327,13 @@ class Game:
                 return
 
     def handle_packet(self, data):
-        offset = 0
-
-        definitions = tlv_definitions.TLVDefinitions(tag_mappings=tlv_definitions.mappings)
-        tlv_parser = TLVParser(definitions)
-
-        packet_id = int.from_bytes(data[offset:offset + definitions.tag_size], byteorder='big')
-        offset += definitions.tag_size
+        view = memoryview(data)
+        packet_id, offset = self.client.tlv_parser.read_packet_id(view)
 
         print("pid", hex(packet_id))
 
         try:
-            fields = tlv_parser.parse_tlv(data, offset)
+            fields = self.client.tlv_parser.parse_tlv(view, offset)
         except ValueError as e:
             print(e)
 
@@ -393,7 +397,10 @@ class Game:
             with self.lock:
                 self.state = "GAME"
                 self.game_info = fields[0]
+                self.position_sequence = None
+                self.position_snapshots = {}
         elif packet_id == config.ACCEPTED:
+            self.client.server_capabilities = fields[1] if len(fields) > 1 else 0
             self.state = "REGISTER"
         elif packet_id == config.RESPONSE_CREATE_ROOM_RESULT:
             if fields[0]:
@@ -420,9 +427,23 @@ class Game:
         elif packet_id == config.SIGNAL_UPDATE_POSITIONS:
             with self.lock:
                 self.game_info["player_positions"] = fields[0]
+                if len(fields) > 1:
+                    self.store_position_snapshot(fields[1], fields[0])
+        elif packet_id == config.SIGNAL_POSITIONS_DELTA:
+            sequence, base_sequence, deltas = fields
+            with self.lock:
+                base = self.position_snapshots.get(base_sequence)
+                if base is not None:
+                    positions = base.copy()
+                    positions[deltas[:, 0]] += deltas[:, 1:]
+                    self.game_info["player_positions"] = positions
+                    self.store_position_snapshot(sequence, positions)
         elif packet_id == config.RESPONSE_MOVE_RESULT:
             if fields[0] is False:
                 print("server refused the move")
+        elif packet_id == config.RESPONSE_MOVE_BATCH_RESULT:
+            if fields[0] is False:
+                print("server refused the moves")
         elif packet_id == config.SIGNAL_SCORE_UPDATE:
             with self.lock:
                 self.winner = fields[0]
@@ -431,13 +452,16 @@ class Game:
         else:
             pass
 
-    def draw_maze(self, surface, m, color_map, cell_size):
-        maze_map = m
+    def store_position_snapshot(self, sequence, positions):
+        self.position_snapshots[sequence] = positions
+        self.position_sequence = sequence
+        for old_sequence in [s for s in self.position_snapshots if s <= sequence - config.POSITION_HISTORY]:
+            del self.position_snapshots[old_sequence]
 
-        for y in range(len(m[0])):
-            for x in range(len(m)):
-                pygame.draw.rect(surface, color_map[maze_map[x][y]],
-                                 pygame.Rect(x * cell_size, y * cell_size, cell_size, cell_size))
+    def draw_maze(self, surface, m, color_map, cell_size):
+        # Look every cell's colour up at once and scale cells up to cell_size pixels
+        pixels = color_map[m].repeat(cell_size, axis=0).repeat(cell_size, axis=1)
+        pygame.surfarray.blit_array(surface, pixels)
 
     def draw_centered_maze(self, screen, maze_surface):
         cx, cy = screen.get_rect().center
@@ -450,35 +474,39 @@ class Game:
         SCREEN_WIDTH = 800
         SCREEN_HEIGHT = 579
         PADDING = 50
-        MAZE_WIDTH = len(self.game_info["map"][0])
-        MAZE_HEIGHT = len(self.game_info["map"])
+        MAZE_HEIGHT, MAZE_WIDTH = self.game_info["map"].shape
         CELL_SIZE = min(((SCREEN_WIDTH - (2 * PADDING)) // MAZE_WIDTH),
                         ((SCREEN_HEIGHT - (2 * PADDING)) // MAZE_HEIGHT))
         maze = self.game_info["map"]
         self.screen.fill((0, 0, 0))
 
-        maze_surface = pygame.Surface((CELL_SIZE * len(maze), CELL_SIZE * len(maze[0])))
+        # The map only changes with a new game, so the surface is built once per map
+        if self.maze_surface is None or self.maze_surface_map is not maze:
+            self.maze_surface = pygame.Surface((CELL_SIZE * MAZE_HEIGHT, CELL_SIZE * MAZE_WIDTH))
 
-        flattened_matrix = [element for row in maze for element in row]
-        matrix_set = set(flattened_matrix)
-        color_map = dict(zip(matrix_set, self.game_info["map_colours"]))
+            cell_values, cell_indices = np.unique(maze, return_inverse=True)
+            color_map = self.game_info["map_colours"][:len(cell_values)]
 
-        self.draw_maze(maze_surface, maze, color_map, CELL_SIZE)
+            self.draw_maze(self.maze_surface, cell_indices.reshape(maze.shape), color_map, CELL_SIZE)
+            self.maze_surface_map = maze
+        maze_surface = self.maze_surface
         self.draw_centered_maze(self.screen, maze_surface)
 
         cx, cy = self.screen.get_rect().center
         maze_x = maze_surface.get_rect(center=(cx, cy)).x
         maze_y = maze_surface.get_rect(center=(cx, cy)).y
 
+        positions = self.game_info["player_positions"]
+        absolute_positions = (positions * CELL_SIZE + (maze_x, maze_y)).tolist()
+        colours = self.game_info["player_colours"].tolist()
+
         all_sprites = pygame.sprite.Group()
         for i in range(self.room_info["current_players"]):
-            position = self.game_info["player_positions"][i]
-            colour = self.game_info["player_colours"][i]
             player = Player(cell_size=CELL_SIZE,
-                            absolute=(position[0] * CELL_SIZE + maze_x, position[1] * CELL_SIZE + maze_y),
-                            relative=position,
+                            absolute=absolute_positions[i],
+                            relative=positions[i],
                             maze=maze,
-                            colour=colour
+                            colour=colours[i]
                             )
             all_sprites.add(player)
 
@@ -0,0 +1,205 @@
+"""
+Micro-benchmarks of the TLV codecs on realistic payloads.
+
+Run from the repository root:
+
+    python -m networking.benchmark --output results.json
+    python -m networking.benchmark --baseline results.json --tolerance 0.15
+
+Each case is encoded and decoded separately. For every operation the suite
+reports the throughput (ops/sec), the encoded size in bytes and the peak
+memory allocated by a single operation, as traced by tracemalloc. Compared
+against a baseline, the run fails when a case got slower, bigger or
+allocates more than the tolerance allows.
+"""
+import argparse
+import json
+import platform
+import random
+import sys
+import time
+import tracemalloc
+
+from networking import config, tlv_definitions
+from networking.server.round import MAP_HEIGHTS, MAP_WIDTHS, generate_map, generate_palette
+
+ROOM_COUNT = 300
+SNAPSHOT_PLAYERS = (4, 16, 64)
+
+
+def room_info(i):
+    players = [f"player{i}_{n}" for n in range(i % 4 + 1)]
+    return {
+        "id": f"room-{i:04d}",
+        "current_players": len(players),
+        "max_players": 4,
+        "state": 0x5001,
+        "players": players,
+        "round": i % 5,
+        "num_rounds": 5,
+        "owner": players[0],
+        "min_players": 2,
+    }
+
+
+def largest_game_info():
+    generated_map = generate_map(max(MAP_HEIGHTS), max(MAP_WIDTHS))
+    maze = generated_map.tolist()
+    return {
+        "map": maze,
+        "player_colours": generate_palette(4),
+        "map_colours": generate_palette(len(set(generated_map.flat))),
+        "player_positions": [(1, 1), (1, len(maze[0]) - 2), (len(maze) - 2, 1), (len(maze) - 2, len(maze[0]) - 2)],
+    }
+
+
+def build_cases():
+    """
+    Returns a dict mapping every case name to a function encoding a whole packet.
+    """
+    random.seed(0)
+    parser = tlv_definitions.parser
+    templates = tlv_definitions.templates
+    jwt_token = "e" * 160
+    rooms = [room_info(i) for i in range(ROOM_COUNT)]
+    game_info = largest_game_info()
+
+    cases = {
+        "login_request": lambda: parser.encode_tlv_packet(config.REQUEST_LOGIN, [
+            (config.TAG_USERNAME, "player1"),
+            (config.TAG_PASSWORD, "correct horse battery staple"),
+            (config.TAG_CAPABILITIES, config.CLIENT_CAPABILITIES),
+        ]),
+        "login_result": lambda: parser.encode_tlv_packet(config.RESPONSE_LOGIN_RESULT, [
+            (config.TAG_SUCCESS, True),
+            (config.TAG_JWT_TOKEN, jwt_token),
+        ]),
+        f"list_rooms_{ROOM_COUNT}": lambda: parser.encode_tlv_packet(config.RESPONSE_LIST_ROOMS_RESULT, [
+            (config.TAG_ROOMS, rooms),
+        ]),
+        "game_info_largest": lambda: parser.encode_tlv_packet(config.SIGNAL_START_GAME, [
+            (config.TAG_GAME_INFO, dict(game_info, packed_map=False)),
+        ]),
+        "game_info_largest_packed": lambda: parser.encode_tlv_packet(config.SIGNAL_START_GAME, [
+            (config.TAG_GAME_INFO, dict(game_info, packed_map=True)),
+        ]),
+        "move_request": lambda: templates.encode(config.REQUEST_MOVE, jwt_token, "player1", "room-0001", "UP", 42),
+    }
+    for players in SNAPSHOT_PLAYERS:
+        positions = [(random.randrange(55), random.randrange(35)) for _ in range(players)]
+        cases[f"positions_{players}"] = (
+            lambda positions=positions: templates.encode(config.SIGNAL_UPDATE_POSITIONS, positions, 42))
+    return cases
+
+
+def measure(func, min_time=0.2, repeat=5):
+    """
+    Returns the best ops/sec of func over repeat runs of at least min_time seconds.
+    """
+    number = 1
+    while True:
+        start = time.perf_counter()
+        for _ in range(number):
+            func()
+        elapsed = time.perf_counter() - start
+        if elapsed >= min_time:
+            break
+        number *= 2 if elapsed == 0 else max(2, int(min_time / elapsed) + 1)
+
+    best = elapsed
+    for _ in range(repeat - 1):
+        start = time.perf_counter()
+        for _ in range(number):
+            func()
+        best = min(best, time.perf_counter() - start)
+    return number / best
+
+
+def allocated_bytes(func):
+    func()
+    tracemalloc.start()
+    try:
+        tracemalloc.reset_peak()
+        before = tracemalloc.get_traced_memory()[0]
+        func()
+        return tracemalloc.get_traced_memory()[1] - before
+    finally:
+        tracemalloc.stop()
+
+
+def run(names=None, min_time=0.2):
+    parser = tlv_definitions.parser
+    length_size = tlv_definitions.tag_definitions.length_size
+    results = {}
+    for name, encode in build_cases().items():
+        if names and name not in names:
+            continue
+        packet = encode()
+        frame = packet[length_size:]
+        decode = lambda: parser.parse_packet(frame)
+        decode()
+
+        results[name] = {
+            "encode": {"ops_per_sec": measure(encode, min_time), "bytes": len(packet),
+                       "alloc_bytes": allocated_bytes(encode)},
+            "decode": {"ops_per_sec": measure(decode, min_time), "bytes": len(packet),
+                       "alloc_bytes": allocated_bytes(decode)},
+        }
+        for operation, result in results[name].items():
+            print(f"{name:<28} {operation:<6} {result['ops_per_sec']:>14,.0f} ops/s "
+                  f"{result['bytes']:>8} B {result['alloc_bytes']:>10} B allocated")
+    return results
+
+
+def compare(results, baseline, tolerance):
+    """
+    Returns the regressions of results against a baseline as a list of messages.
+    """
+    regressions = []
+    for name, operations in results.items():
+        for operation, result in operations.items():
+            reference = baseline.get(name, {}).get(operation)
+            if reference is None:
+                continue
+            label = f"{name} {operation}"
+            if result["ops_per_sec"] < reference["ops_per_sec"] * (1 - tolerance):
+                regressions.append(f"{label}: {result['ops_per_sec']:,.0f} ops/s, "
+                                   f"baseline {reference['ops_per_sec']:,.0f} ops/s")
+            if result["bytes"] > reference["bytes"]:
+                regressions.append(f"{label}: {result['bytes']} bytes, baseline {reference['bytes']} bytes")
+            if result["alloc_bytes"] > reference["alloc_bytes"] * (1 + tolerance):
+                regressions.append(f"{label}: {result['alloc_bytes']} bytes allocated, "
+                                   f"baseline {reference['alloc_bytes']} bytes allocated")
+    return regressions
+
+
+def main():
+    argument_parser = argparse.ArgumentParser(description="Benchmark the TLV codecs.")
+    argument_parser.add_argument("cases", nargs="*", help="Only run these cases")
+    argument_parser.add_argument("--output", help="Write the results to this JSON file")
+    argument_parser.add_argument("--baseline", help="Compare the results against this JSON file")
+    argument_parser.add_argument("--tolerance", type=float, default=0.1,
+                                 help="Allowed relative slowdown and allocation growth (default 0.1)")
+    argument_parser.add_argument("--min-time", type=float, default=0.2,
+                                 help="Minimum duration in seconds of a timed run (default 0.2)")
+    args = argument_parser.parse_args()
+
+    results = run(args.cases, args.min_time)
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump({"python": platform.python_version(), "results": results}, f, indent=2)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)["results"]
+        regressions = compare(results, baseline, args.tolerance)
+        for regression in regressions:
+            print(f"REGRESSION {regression}")
+        if regressions:
+            sys.exit(1)
+        print(f"No regressions against {args.baseline}")
+
+
+if __name__ == "__main__":
+    main()
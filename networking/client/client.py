@@ -1,9 +1,12 @@
+import itertools
 import queue
 import socket
 import ssl
 import threading
-import struct
+from collections import deque
+from concurrent.futures import Future
 from networking.tlv_parser import TLVParser
+from networking.frame_decoder import FrameDecoder
 from networking import config, tlv_definitions
 
 class Client:
@@ -12,68 +15,132 @@ class Client:
         self.tlv_parser = TLVParser(tlv_definitions.tag_definitions)
         self.lock = threading.Lock()
         self.event_queue = queue.Queue()
+        self.server_capabilities = 0
+        self.ssl_context = None
+        self.ssl_certfile = None
+        # Kept across reconnects to resume the TLS session instead of a full handshake
+        self.ssl_session = None
+        # Futures of the requests waiting for a response, by request ID, or by
+        # response packet ID in sending order for servers without request IDs
+        self.pending_lock = threading.Lock()
+        self.request_ids = itertools.count(1)
+        self.pending_requests = {}
+        self.pending_responses = {}
+        # Numbers the futures of pending_responses, errors go to the oldest one
+        self.response_order = itertools.count()
 
     def connect(self, server_address, port, certfile):
         try:
-            self.sock = socket.socket()
-            context = ssl.SSLContext(ssl.PROTOCOL_TLS_CLIENT)
-            context.check_hostname = False
-            context.load_verify_locations(certfile)
-
-            self.sock = context.wrap_socket(self.sock, server_side=False)
+            if self.ssl_context is None or self.ssl_certfile != certfile:
+                context = ssl.SSLContext(ssl.PROTOCOL_TLS_CLIENT)
+                context.check_hostname = False
+                context.load_verify_locations(certfile)
+                self.ssl_context, self.ssl_certfile = context, certfile
+                self.ssl_session = None
+
+            self.sock = self.ssl_context.wrap_socket(socket.socket(), server_side=False, session=self.ssl_session)
             self.sock.connect((server_address, port))
-            threading.Thread(target=self.listen_to_server).start()
+            threading.Thread(target=self.listen_to_server, args=(self.sock,)).start()
             return True
         except socket.error as e:
             print(e)
             return False
 
-    def listen_to_server(self):
+    def listen_to_server(self, sock):
+        frame_decoder = FrameDecoder(self.tlv_parser.tag_definitions.length_size)
+        session_saved = False
         while True:
-            raw_packet_length = self.recv_all(2)
-            if not raw_packet_length:
+            frames = frame_decoder.recv_from(sock)
+            if frames is None:
                 break
 
-            packet_length = struct.unpack("!H", raw_packet_length)[0]
-            data = self.recv_all(packet_length - 2)
-            print("data", data)
-            if not data:
-                break
-            self.event_queue.put(data)
+            # TLS 1.3 tickets arrive after the handshake, along with the first packets
+            if not session_saved and sock.session is not None and sock.session.has_ticket:
+                self.ssl_session = sock.session
+                session_saved = True
+
+            for data in frames:
+                packet_id, request_id, offset = self.tlv_parser.read_packet_header(data)
+                if request_id is not None:
+                    # Handed on without the request ID, like the other packets
+                    data = packet_id.to_bytes(self.tlv_parser.tag_definitions.tag_size, "big") + data[offset:]
+                self.event_queue.put(data)
+                self.resolve_request(packet_id, request_id, data)
+
+        with self.pending_lock:
+            futures = list(self.pending_requests.values())
+            futures.extend(future for futures_by_packet in self.pending_responses.values()
+                           for _, future in futures_by_packet)
+            self.pending_requests.clear()
+            self.pending_responses.clear()
+        for future in futures:
+            if not future.cancelled():
+                future.set_exception(ConnectionError("Connection to the server closed"))
+
+    def resolve_request(self, packet_id, request_id, data):
+        with self.pending_lock:
+            if request_id is not None:
+                future = self.pending_requests.pop(request_id, None)
+            else:
+                if packet_id in (config.RESPONSE_ERROR, config.RESPONSE_AUTH_ERROR):
+                    # An error answers whichever request was sent first
+                    futures = min((futures for futures in self.pending_responses.values() if futures),
+                                  key=lambda futures: futures[0][0], default=None)
+                else:
+                    futures = self.pending_responses.get(packet_id)
+                future = futures.popleft()[1] if futures else None
+        if future is not None and not future.cancelled():
+            future.set_result(self.tlv_parser.parse_packet(data))
 
     def send_packet(self, packet):
         with self.lock:
             self.sock.sendall(packet)
 
-    def recv_packet(self):
-        if raw_packet_length := self.recv_all(2) is None:
-            return None
-        packet_length = struct.unpack("!H", raw_packet_length)[0]
-        data = self.recv_all(packet_length - 2)
-        return data
-
-    def recv_all(self, num_bytes):
-        data = bytearray()
-        while len(data) < num_bytes:
-            packet = self.sock.recv(num_bytes - len(data))
-            if not packet:
-                return None
-            data.extend(packet)
-        return bytes(data)
+    def send_request(self, packet):
+        """
+        Sends a request and returns a Future resolving to the (packet ID,
+        fields) of its response.
+
+        Requests go out with a request ID when the server supports them, so
+        the response is matched even when answered out of order. Otherwise the
+        future resolves with the next response of the matching type, or the
+        next error if it is the oldest request waiting.
+        """
+        future = Future()
+        if self.server_capabilities & config.CAPABILITY_REQUEST_IDS:
+            with self.pending_lock:
+                request_id = next(self.request_ids) % 2 ** 32
+                self.pending_requests[request_id] = future
+            self.send_packet(self.tlv_parser.add_request_id(packet, request_id))
+            return future
+
+        packet_id, _ = self.tlv_parser.read_packet_id(packet, self.tlv_parser.tag_definitions.length_size)
+        # Each request is answered by the response with the same low byte
+        response_id = packet_id - config.REQUEST_LOGIN + config.RESPONSE_LOGIN_RESULT
+        with self.lock:
+            # Registered under the send lock so the futures queue up in sending order
+            with self.pending_lock:
+                self.pending_responses.setdefault(response_id, deque()).append((next(self.response_order), future))
+            self.sock.sendall(packet)
+        return future
 
     def send_login_request(self, username, password):
-        packet = self.tlv_parser.encode_tlv_packet(config.REQUEST_LOGIN, [
+        fields = [
             (config.TAG_USERNAME, username),
             (config.TAG_PASSWORD, password)
-        ])
-        self.send_packet(packet)
+        ]
+        # Servers that don't advertise capabilities don't expect the extra field
+        if capabilities := config.CLIENT_CAPABILITIES & self.server_capabilities:
+            fields.append((config.TAG_CAPABILITIES, capabilities))
+        packet = self.tlv_parser.encode_tlv_packet(config.REQUEST_LOGIN, fields)
+        return self.send_request(packet)
 
     def send_register_request(self, username, password):
         packet = self.tlv_parser.encode_tlv_packet(config.REQUEST_REGISTER, [
             (config.TAG_USERNAME, username),
             (config.TAG_PASSWORD, password)
         ])
-        self.send_packet(packet)
+        return self.send_request(packet)
 
     def send_create_room(self, username, jwt_token, room_code):
         packet = self.tlv_parser.encode_tlv_packet(config.REQUEST_CREATE_ROOM,[
@@ -81,7 +148,7 @@ class Client:
             (config.TAG_USERNAME, username),
             (config.TAG_ROOM_ID, room_code),
         ])
-        self.send_packet(packet)
+        return self.send_request(packet)
 
     def send_join_room(self, username, jwt_token, room_code):
         packet = self.tlv_parser.encode_tlv_packet(config.REQUEST_JOIN_ROOM, [
@@ -89,7 +156,7 @@ class Client:
             (config.TAG_USERNAME, username),
             (config.TAG_ROOM_ID, room_code),
         ])
-        self.send_packet(packet)
+        return self.send_request(packet)
 
     def send_start_game_request(self, username, jwt_token, room_code):
         packet = self.tlv_parser.encode_tlv_packet(config.REQUEST_START_GAME, [
@@ -97,21 +164,47 @@ class Client:
             (config.TAG_USERNAME, username),
             (config.TAG_ROOM_ID, room_code),
         ])
-        self.send_packet(packet)
-
-    def send_move_request(self, username, jwt_token, direction, room_code):
-        packet = self.tlv_parser.encode_tlv_packet(config.REQUEST_MOVE, [
-            (config.TAG_JWT_TOKEN, jwt_token),
-            (config.TAG_USERNAME, username),
-            (config.TAG_ROOM_ID, room_code),
-            (config.TAG_DIRECTION, direction)
-        ])
-        self.send_packet(packet)
+        return self.send_request(packet)
+
+    def send_move_request(self, username, jwt_token, direction, room_code, acknowledged_sequence=None):
+        # Acknowledging the latest snapshot lets the server send deltas against it
+        if not self.server_capabilities & config.CAPABILITY_DELTA_POSITIONS:
+            acknowledged_sequence = None
+        packet = tlv_definitions.templates.encode(config.REQUEST_MOVE, jwt_token, username, room_code, direction,
+                                                  acknowledged_sequence)
+        return self.send_request(packet)
+
+    def send_move_batch_request(self, username, jwt_token, moves, room_code, acknowledged_sequence=None):
+        """
+        Sends the moves of a frame, a list of (direction, timestamp in ms),
+        in one request, or one request per move to servers without batches.
+
+        Returns:
+            The futures of the requests sent.
+        """
+        if not self.server_capabilities & config.CAPABILITY_MOVE_BATCH:
+            return [self.send_move_request(username, jwt_token, direction, room_code, acknowledged_sequence)
+                    for direction, _ in moves]
+
+        futures = []
+        for start in range(0, len(moves), config.MAX_MOVE_BATCH):
+            batch = [(config.DIRECTIONS.index(direction), timestamp % 2 ** 32)
+                     for direction, timestamp in moves[start:start + config.MAX_MOVE_BATCH]]
+            fields = [
+                (config.TAG_JWT_TOKEN, jwt_token),
+                (config.TAG_USERNAME, username),
+                (config.TAG_ROOM_ID, room_code),
+                (config.TAG_MOVES, batch),
+            ]
+            if acknowledged_sequence is not None and self.server_capabilities & config.CAPABILITY_DELTA_POSITIONS:
+                fields.append((config.TAG_SEQUENCE, acknowledged_sequence))
+            futures.append(self.send_request(self.tlv_parser.encode_tlv_packet(config.REQUEST_MOVE_BATCH, fields)))
+        return futures
 
     def send_leave_room_request(self, username, jwt_token):
         packet = self.tlv_parser.encode_tlv_packet(config.REQUEST_LEAVE_ROOM, [
             (config.TAG_JWT_TOKEN, jwt_token),
             (config.TAG_USERNAME, username)
         ])
-        self.send_packet(packet)
+        return self.send_request(packet)
 
@@ -4,6 +4,108 @@ SERVER_PORT =         10305
 
 MAX_CLIENTS = 64
 
+# Connections served at once, in total and from a single IP address, before
+# new ones are closed right after the accept
+MAX_CONNECTIONS = 1024
+MAX_CONNECTIONS_PER_IP = 32
+# Seconds a connection may stay without logging in, a logged in client may
+# send nothing, and a client may take to finish sending a started packet
+LOGIN_TIMEOUT = 300.0
+IDLE_TIMEOUT = 3600.0
+READ_TIMEOUT = 10.0
+# Seconds between two sweeps closing the connections past a timeout
+REAPER_INTERVAL = 5.0
+
+# "threads" serves every client on its own thread, "asyncio" serves them all from one event loop
+SERVER_ENGINE = "threads"
+
+# TLS 1.3 session tickets sent after each full handshake, used by reconnecting clients
+TLS_SESSION_TICKETS = 2
+
+# Threads running TLS handshakes for the threaded engine, and the accepted
+# sockets allowed to wait for one before new connections are dropped
+HANDSHAKE_WORKERS = 32
+HANDSHAKE_QUEUE_SIZE = 256
+# Seconds a client may stall a handshake (both engines)
+HANDSHAKE_TIMEOUT = 5.0
+
+# Bytes queued for a client before the overflow policy kicks in: "drop_snapshots"
+# drops position snapshots and disconnects the client only when other packets
+# overflow, "disconnect" disconnects it right away
+OUTBOUND_QUEUE_BYTES = 1 << 20
+OUTBOUND_OVERFLOW_POLICY = "drop_snapshots"
+# Seconds a single write to a client may block before it is disconnected
+SLOW_CLIENT_TIMEOUT = 10.0
+
+# CAPABILITIES, negotiated through the ACCEPTED and REQUEST_LOGIN packets
+CAPABILITY_PACKED_MAP = 0x0001
+CAPABILITY_DELTA_POSITIONS = 0x0002
+CAPABILITY_MOVE_BATCH = 0x0004
+CAPABILITY_REQUEST_IDS = 0x0008
+
+SERVER_CAPABILITIES = (CAPABILITY_PACKED_MAP | CAPABILITY_DELTA_POSITIONS | CAPABILITY_MOVE_BATCH
+                       | CAPABILITY_REQUEST_IDS)
+CLIENT_CAPABILITIES = (CAPABILITY_PACKED_MAP | CAPABILITY_DELTA_POSITIONS | CAPABILITY_MOVE_BATCH
+                       | CAPABILITY_REQUEST_IDS)
+
+# A packet ID with this bit set is followed by a 4-byte request ID, echoed in
+# the header of the response. Requests with an ID may be answered out of order
+REQUEST_ID_FLAG = 0x8000
+# Processes hashing passwords, and the hashes allowed to wait for one before
+# logins and registrations are turned away as busy
+HASH_WORKERS = 4
+HASH_QUEUE_SIZE = 64
+# Login and registration attempts allowed per second from one IP address and
+# for one username, and the bursts allowed above that rate. Limited attempts
+# are turned away before any hashing
+AUTH_RATE_PER_IP = 2.0
+AUTH_BURST_PER_IP = 20
+AUTH_RATE_PER_USERNAME = 0.5
+AUTH_BURST_PER_USERNAME = 5
+# IP addresses and usernames whose attempts are tracked at once
+RATE_LIMITER_KEYS = 65536
+
+# Where the users are kept: "sqlite" (users.db, importing users.json once) or
+# "json" (the whole users.json rewritten on every registration), and the most
+# registrations committed in one transaction
+USER_STORE = "sqlite"
+USER_STORE_BATCH_SIZE = 256
+
+# Verified tokens remembered until they expire, so requests of clients that
+# reconnected or go through another server skip the signature check
+JWT_CACHE_SIZE = 4096
+
+# Level of the server log, "TRACE" adds an entry per move
+LOG_LEVEL = "INFO"
+# Messages per second, and bursts above that, logged for an event type that
+# may flood the log (rejected connections, failed handshakes)
+LOG_SAMPLE_RATE = 1.0
+LOG_SAMPLE_BURST = 10
+
+# Threads running the slow requests (logins, game starts) sent with an ID
+REQUEST_WORKERS = 16
+
+# Moves of a REQUEST_MOVE_BATCH travel as an index into DIRECTIONS and a
+# millisecond client timestamp (modulo 2**32)
+DIRECTIONS = ("UP", "DOWN", "LEFT", "RIGHT")
+MAX_MOVE_BATCH = 32
+
+# zlib level for packed maps, 0 sends them uncompressed
+MAP_COMPRESSION_LEVEL = 6
+
+# Position snapshots kept per room to compute deltas against
+POSITION_HISTORY = 32
+
+# Ticks per second of playing rooms, 0 applies every move and broadcasts the
+# positions right away. In tick mode moves are queued and applied in order on
+# the next tick, which ends with at most one snapshot broadcast
+ROOM_TICK_RATE = 0
+ROOM_MAX_PENDING_MOVES = 256
+
+# Worker processes owning the rooms behind a front process that terminates TLS
+# and handles logins, 0 keeps every room in the server process
+SHARD_WORKERS = 0
+
 ACCEPTED = 0x1222
 
 TAG_USERNAME = 0x1002
@@ -32,6 +134,14 @@ TAG_NUM_ROUNDS = 0x1024
 TAG_MIN_PLAYERS = 0x1025
 TAG_OWNER = 0x1026
 TAG_DIRECTION = 0x1027
+TAG_PACKED_MAP = 0x1028
+TAG_CAPABILITIES = 0x1029
+TAG_SEQUENCE = 0x102A
+TAG_BASE_SEQUENCE = 0x102B
+TAG_POSITION_DELTAS = 0x102C
+TAG_MOVES = 0x102D
+TAG_MOVE = 0x102E
+TAG_MOVES_APPLIED = 0x102F
 TAG_ERROR_MESSAGE = 0x1100
 
 REQUEST_LOGIN = 0x2001
@@ -42,6 +152,7 @@ REQUEST_LIST_ROOMS = 0x2005
 REQUEST_CREATE_ROOM = 0x2006
 REQUEST_START_GAME = 0x2007
 REQUEST_MOVE = 0x2008
+REQUEST_MOVE_BATCH = 0x2009
 
 RESPONSE_LOGIN_RESULT = 0x3001
 RESPONSE_REGISTER_RESULT = 0x3002
@@ -51,6 +162,7 @@ RESPONSE_LIST_ROOMS_RESULT = 0x3005
 RESPONSE_CREATE_ROOM_RESULT = 0x3006
 RESPONSE_START_GAME_RESULT = 0x3007
 RESPONSE_MOVE_RESULT = 0x3008
+RESPONSE_MOVE_BATCH_RESULT = 0x3009
 RESPONSE_AUTH_ERROR = 0x4001
 RESPONSE_ERROR = 0x4002
 
@@ -61,4 +173,5 @@ SIGNAL_PLAYER_JOIN = 0x6004
 SIGNAL_GAME_OVER = 0x6005
 SIGNAL_SCORE_UPDATE = 0x6006
 SIGNAL_UPDATE_POSITIONS = 0x6007
+SIGNAL_POSITIONS_DELTA = 0x6008
 SIGNAL_ERROR = 0x6100
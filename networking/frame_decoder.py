@@ -0,0 +1,83 @@
+import struct
+
+_LENGTH_FORMATS = {1: "!B", 2: "!H", 4: "!I"}
+
+
+class FrameDecoder:
+    def __init__(self, length_size=2, buffer_size=65536):
+        """
+        Incrementally splits a byte stream into length-prefixed frames.
+
+        The prefix counts itself, so a frame of length n carries n - length_size
+        bytes of payload (packet ID followed by the TLV fields).
+
+        Args:
+            length_size: The size in bytes of the frame length prefix.
+            buffer_size: The initial size of the receive buffer.
+        """
+        self.length = struct.Struct(_LENGTH_FORMATS[length_size])
+        self.buffer = bytearray(buffer_size)
+        self.start = 0
+        self.end = 0
+
+    def feed(self, data):
+        """
+        Appends received bytes and returns every complete frame payload.
+        """
+        self._reserve(len(data))
+        self.buffer[self.end:self.end + len(data)] = data
+        self.end += len(data)
+        return self._drain()
+
+    def recv_from(self, sock):
+        """
+        Reads whatever the socket has into the buffer and returns every complete
+        frame payload, or None once the peer has closed the connection.
+        """
+        self._reserve(1)
+        with memoryview(self.buffer) as view:
+            received = sock.recv_into(view[self.end:])
+        if not received:
+            return None
+        self.end += received
+        return self._drain()
+
+    def has_partial_frame(self):
+        """
+        Whether the bytes received so far end in the middle of a frame.
+        """
+        return self.end > self.start
+
+    def _drain(self):
+        frames = []
+        length_size = self.length.size
+        missing = 0
+        with memoryview(self.buffer) as view:
+            while self.end - self.start >= length_size:
+                frame_length = self.length.unpack_from(view, self.start)[0]
+                if frame_length < length_size:
+                    raise ValueError(f"Invalid frame length: {frame_length}")
+                if self.end - self.start < frame_length:
+                    missing = frame_length - (self.end - self.start)
+                    break
+                frames.append(view[self.start + length_size:self.start + frame_length].tobytes())
+                self.start += frame_length
+
+        if self.start == self.end:
+            self.start = self.end = 0
+        elif missing:
+            # Make sure the rest of a large frame fits in the next read
+            self._reserve(missing)
+        return frames
+
+    def _reserve(self, num_bytes):
+        if len(self.buffer) - self.end >= num_bytes:
+            return
+        # Move the pending partial frame to the front before growing the buffer
+        if self.start:
+            pending = self.end - self.start
+            self.buffer[:pending] = self.buffer[self.start:self.end]
+            self.start, self.end = 0, pending
+        shortfall = num_bytes - (len(self.buffer) - self.end)
+        if shortfall > 0:
+            self.buffer.extend(bytes(max(shortfall, len(self.buffer))))
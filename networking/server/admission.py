@@ -0,0 +1,44 @@
+import threading
+
+from networking import config
+
+
+class AdmissionControl:
+    def __init__(self, metrics, max_connections=config.MAX_CONNECTIONS,
+                 max_connections_per_ip=config.MAX_CONNECTIONS_PER_IP):
+        """
+        Caps the connections served at once, in total and per IP address.
+
+        A connection is counted from its accept, handshake included, until
+        release is called for it.
+        """
+        self.metrics = metrics
+        self.max_connections = max_connections
+        self.max_connections_per_ip = max_connections_per_ip
+        self.lock = threading.Lock()
+        self.connections = 0
+        self.connections_by_ip = {}
+
+    def admit(self, ip):
+        """
+        Counts a new connection from ip, returns False if it is over a limit.
+        """
+        with self.lock:
+            from_ip = self.connections_by_ip.get(ip, 0)
+            if self.connections >= self.max_connections or from_ip >= self.max_connections_per_ip:
+                self.metrics.increment("connections_rejected")
+                return False
+            self.connections += 1
+            self.connections_by_ip[ip] = from_ip + 1
+            connections = self.connections
+        self.metrics.set_gauge("connections", connections)
+        return True
+
+    def release(self, ip):
+        with self.lock:
+            self.connections -= 1
+            from_ip = self.connections_by_ip.pop(ip) - 1
+            if from_ip:
+                self.connections_by_ip[ip] = from_ip
+            connections = self.connections
+        self.metrics.set_gauge("connections", connections)
@@ -1,47 +1,141 @@
 import hashlib
+import math
+import multiprocessing
 import os
-import json
+import threading
 import time
 import uuid
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 
 import jwt
 
+from networking import config
+from networking.server.futures import then
+from networking.server.user_store import open_user_store
+
 SECRET_KEY = os.environ['SECRET_KEY']
 
 
+def hash_password(password, salt):
+    """
+    Returns the hex PBKDF2 hash of a password, run in the hashing processes.
+    """
+    return hashlib.pbkdf2_hmac('sha256', password.encode('utf-8'), salt, 100000).hex()
+
+
 class AuthenticationService:
-    def __init__(self):
-        self.users = {}  # Dictionary to store user credentials {username: (hashed_password, salt)}
+    def __init__(self, store=None, hash_workers=config.HASH_WORKERS, max_pending_hashes=config.HASH_QUEUE_SIZE):
+        """
+        Registers and authenticates users, hashing passwords in a pool of
+        hash_workers processes so logins never hold up the server's threads.
+
+        Registering and authenticating return a Future, or None when
+        max_pending_hashes hashes are already waiting for the pool.
+
+        Args:
+            store: The UserStore keeping the credentials, by default the one
+                named by config.USER_STORE.
+        """
+        self.store = store if store is not None else open_user_store()
+        self.hash_workers = hash_workers
+        self.max_pending_hashes = max_pending_hashes
+        self.hash_pool = None
+        self.pending_hashes = 0
+        self.hash_lock = threading.Lock()
+        # Looks users up away from the server's threads and event loop, the store reads one at a time anyway
+        self.lookup_executor = ThreadPoolExecutor(1, thread_name_prefix="user-lookup")
+        # (username, expiration time) of recently verified tokens, least recently used first
+        self.verified_tokens = OrderedDict()
+        self.tokens_lock = threading.Lock()
+
+    def start_hashing(self):
+        """
+        Starts the hashing processes, forked from the current process, so it
+        should be called before the server starts any thread.
+        """
+        with self.hash_lock:
+            if self.hash_pool is not None:
+                return
+            self.hash_pool = ProcessPoolExecutor(self.hash_workers, mp_context=multiprocessing.get_context("fork"))
+        # The fork start method launches every worker on the first submit
+        self.hash_pool.submit(int).result()
+
+    def reserve_hash(self):
+        """
+        Takes one of the max_pending_hashes places, returns False if none is
+        left. The place is given back once the hash is done.
+        """
+        with self.hash_lock:
+            if self.pending_hashes >= self.max_pending_hashes:
+                return False
+            self.pending_hashes += 1
+        return True
+
+    def submit_hash(self, password, salt, reserved=False):
+        """
+        Hashes a password in the pool, returns a Future of the hex hash or
+        None if the pool is too far behind. A caller that already took a
+        place with reserve_hash passes reserved.
+        """
+        if self.hash_pool is None:
+            self.start_hashing()
+        if not reserved and not self.reserve_hash():
+            return None
+        future = self.hash_pool.submit(hash_password, password, salt)
+        future.add_done_callback(self._hash_done)
+        return future
 
-        # Load user credentials from file if present
-        if os.path.exists("users.json"):
-            with open("users.json", "r") as f:
-                self.users = json.load(f)
+    def _hash_done(self, future):
+        with self.hash_lock:
+            self.pending_hashes -= 1
 
     def register_user(self, username, password):
         # Generate salt and hash password
         salt = os.urandom(32)
-        hashed_password = hashlib.pbkdf2_hmac('sha256', password.encode('utf-8'), salt, 100000)
+        future = self.submit_hash(password, salt)
+        if future is None:
+            return None
 
-        self.users[username] = {
-            "hash": hashed_password.hex(),
+        return then(future, lambda hashed_password: self.store.put(username, {
+            "hash": hashed_password,
             "salt": salt.hex(),
-        }
-        self._save_users_to_file()  # Save users to file
-        return True
-
-    def verify_password(self, password, stored_hash, salt):
-        input_hashed_password = hashlib.pbkdf2_hmac('sha256', password.encode('utf-8'), bytes.fromhex(salt), 100000)
-        if stored_hash == input_hashed_password.hex():
-            return True
+        }))
+
+    def verify_password(self, password, stored_hash, salt, reserved=False):
+        """
+        Returns a Future resolving to whether the password matches, or None if
+        the pool is too far behind.
+        """
+        future = self.submit_hash(password, bytes.fromhex(salt), reserved)
+        if future is None:
+            return None
+        return then(future, lambda input_hashed_password: stored_hash == input_hashed_password)
 
     def authenticate_user(self, username, password):
-        if username in self.users and self.verify_password(password, self.users[username]["hash"],
-                                                           self.users[username]["salt"]):
-            jwt_token = self.generate_jwt(username)
-            return True, jwt_token
-        else:
-            return False, None
+        """
+        Returns a Future resolving to (success, JWT token), or None if the pool
+        is too far behind.
+        """
+        # Taken before the lookup, so a busy pool is still answered right away
+        if not self.reserve_hash():
+            return None
+
+        def verify(user):
+            if user is None:
+                self._hash_done(None)
+                return False, None
+            return then(self.verify_password(password, user["hash"], user["salt"], reserved=True),
+                        lambda verified: (True, self.generate_jwt(username)) if verified else (False, None))
+
+        return then(self.lookup_executor.submit(self._lookup_user, username), verify)
+
+    def _lookup_user(self, username):
+        try:
+            return self.store.get(username)
+        except Exception:
+            self._hash_done(None)
+            raise
 
     def generate_jwt(self, username, expiration_seconds=3600):
         payload = {
@@ -54,22 +148,47 @@ class AuthenticationService:
         return jwt_token
 
     def verify_jwt(self, jwt_token):
+        session = self.verify_session(jwt_token)
+        return session[0] if session is not None else None
+
+    def verify_session(self, jwt_token):
+        """
+        Verifies a token, returns the (username, expiration time) it carries or None.
+
+        The config.JWT_CACHE_SIZE tokens verified last are kept until they
+        expire, so checking them again skips the signature verification.
+        """
+        current_time = time.time()
+        with self.tokens_lock:
+            session = self.verified_tokens.get(jwt_token)
+            if session is not None:
+                if session[1] >= current_time:
+                    self.verified_tokens.move_to_end(jwt_token)
+                    return session
+                del self.verified_tokens[jwt_token]
+
         try:
             payload = jwt.decode(jwt_token, SECRET_KEY, algorithms=["HS256", ])
-            current_time = time.time()
             expiration_time = payload.get("exp")
             if expiration_time and expiration_time < current_time:
                 return None
-
-            return payload["username"]
+            session = (payload["username"], expiration_time or math.inf)
         except jwt.ExpiredSignatureError:
             return None
         except jwt.InvalidTokenError:
             return None
 
-    def _save_users_to_file(self):
-        with open("users.json", "w") as f:
-            json.dump(self.users, f)
+        with self.tokens_lock:
+            self.verified_tokens[jwt_token] = session
+            if len(self.verified_tokens) > config.JWT_CACHE_SIZE:
+                self.verified_tokens.popitem(last=False)
+        return session
+
+    def close(self):
+        self.lookup_executor.shutdown()
+        self.store.close()
+        if self.hash_pool is not None:
+            self.hash_pool.shutdown(wait=False)
 
 
 # Example usage:
@@ -77,9 +196,9 @@ if __name__ == "__main__":
     auth_service = AuthenticationService()
 
     # Register a new user
-    auth_service.register_user("user123", "password123")
+    auth_service.register_user("user123", "password123").result()
 
     # Authenticate a user
-    token = auth_service.authenticate_user("user123", "password123")[1]
+    token = auth_service.authenticate_user("user123", "password123").result()[1]
     print(token)
     print(auth_service.verify_jwt(token))
@@ -1,6 +1,8 @@
+from networking import config
 from server import Server
+from sharding import ShardedServer
 
 
 def main_loop():
-    server = Server()
+    server = ShardedServer() if config.SHARD_WORKERS else Server()
     server.start()
\ No newline at end of file
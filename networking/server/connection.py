@@ -0,0 +1,242 @@
+import abc
+import asyncio
+import socket
+import threading
+import time
+from collections import deque
+
+from networking import config
+
+OVERFLOW_DROP_SNAPSHOTS = "drop_snapshots"
+OVERFLOW_DISCONNECT = "disconnect"
+
+
+class OutboundQueue(abc.ABC):
+    def __init__(self, metrics, max_bytes=config.OUTBOUND_QUEUE_BYTES, policy=config.OUTBOUND_OVERFLOW_POLICY):
+        """
+        A bounded queue of packets waiting to be written to one client, so
+        senders never wait on the client's TCP window.
+
+        Packets sent as replaceable (position snapshots) supersede the ones
+        still queued. Once the queue holds more than max_bytes, the
+        drop_snapshots policy drops new replaceable packets and disconnects
+        the client only when other packets overflow, the disconnect policy
+        disconnects it right away. A client whose current write has been
+        stuck for config.SLOW_CLIENT_TIMEOUT seconds is disconnected either way.
+
+        Subclasses provide the writer through _wake, which signals it that
+        packets are queued, and _abort, which tears down the connection.
+        """
+        if policy not in (OVERFLOW_DROP_SNAPSHOTS, OVERFLOW_DISCONNECT):
+            raise ValueError(f"Unknown overflow policy: {policy}")
+        self.metrics = metrics
+        self.max_bytes = max_bytes
+        self.policy = policy
+        self.lock = threading.Lock()
+        self.packets = deque()
+        self.queued_bytes = 0
+        self.replaceable_packets = 0
+        self.closed = False
+        # When the write in progress started, None while the writer is idle
+        self.write_started = None
+        # The Player logged in on this connection, and when the client was last heard from
+        self.player = None
+        self.ip = None
+        # (JWT token, username, expiration time) of the token verified on this connection
+        self.session = None
+        self.connected_at = time.monotonic()
+        self.last_received = self.connected_at
+        self.partial_since = None
+
+    def sendall(self, data, replaceable=False):
+        with self.lock:
+            if self.closed:
+                return
+            if replaceable and self.replaceable_packets:
+                self._drop_replaceable()
+
+            if self.queued_bytes + len(data) > self.max_bytes or self._stalled():
+                if self.policy == OVERFLOW_DROP_SNAPSHOTS and replaceable and not self._stalled():
+                    self.metrics.increment("outbound_dropped")
+                    return
+                self.metrics.increment("slow_clients_disconnected")
+                self._close()
+                self._abort()
+                return
+
+            self.packets.append((data, replaceable))
+            self.queued_bytes += len(data)
+            self.replaceable_packets += replaceable
+        self._wake()
+
+    def close(self):
+        with self.lock:
+            self._close()
+        self._wake()
+
+    def disconnect(self):
+        """
+        Closes the connection from any thread, unblocking its reader.
+        """
+        with self.lock:
+            self._close()
+            self._abort()
+
+    def received(self, partial):
+        """
+        Records bytes received from the client, partial when they leave a
+        packet unfinished.
+        """
+        now = time.monotonic()
+        self.last_received = now
+        if not partial:
+            self.partial_since = None
+        elif self.partial_since is None:
+            self.partial_since = now
+
+    def timed_out(self, now):
+        """
+        Returns which of the login, idle or read timeouts the connection is
+        past, or None.
+        """
+        if self.partial_since is not None and now - self.partial_since > config.READ_TIMEOUT:
+            return "read"
+        if self.player is None and now - self.connected_at > config.LOGIN_TIMEOUT:
+            return "login"
+        if now - self.last_received > config.IDLE_TIMEOUT:
+            return "idle"
+        return None
+
+    def take_packets(self):
+        """
+        Empties the queue into one buffer for the writer, returns None once
+        the connection is closed.
+        """
+        with self.lock:
+            if self.closed:
+                return None
+            self.metrics.observe("outbound_queue_bytes", self.queued_bytes)
+            data = b"".join(packet for packet, _ in self.packets)
+            self.packets.clear()
+            self.queued_bytes = 0
+            self.replaceable_packets = 0
+            self.write_started = time.monotonic()
+            return data
+
+    def _drop_replaceable(self):
+        superseded = [packet for packet in self.packets if packet[1]]
+        self.packets = deque(packet for packet in self.packets if not packet[1])
+        self.queued_bytes -= sum(len(packet) for packet, _ in superseded)
+        self.replaceable_packets = 0
+        self.metrics.increment("outbound_superseded", len(superseded))
+
+    def _stalled(self):
+        return self.write_started is not None and time.monotonic() - self.write_started > config.SLOW_CLIENT_TIMEOUT
+
+    def _close(self):
+        self.closed = True
+        self.packets.clear()
+        self.queued_bytes = 0
+        self.replaceable_packets = 0
+
+    @abc.abstractmethod
+    def _wake(self):
+        pass
+
+    @abc.abstractmethod
+    def _abort(self):
+        pass
+
+
+class SocketConnection(OutboundQueue):
+    def __init__(self, sock, metrics):
+        """
+        Queues the packets of a client socket, written by a dedicated thread.
+        """
+        super().__init__(metrics)
+        self.sock = sock
+        self.ready = threading.Condition(self.lock)
+        threading.Thread(target=self.write_packets, daemon=True).start()
+
+    def write_packets(self):
+        while True:
+            with self.ready:
+                while not self.packets and not self.closed:
+                    self.ready.wait()
+            data = self.take_packets()
+            if data is None:
+                return
+            try:
+                self.sock.sendall(data)
+            except OSError:
+                self.close()
+                return
+            finally:
+                self.write_started = None
+
+    def getpeername(self):
+        return self.sock.getpeername()
+
+    def _wake(self):
+        with self.ready:
+            self.ready.notify()
+
+    def _abort(self):
+        # Unblocks both the reading thread and the writer, the reading thread closes the socket
+        try:
+            self.sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+
+
+class StreamConnection(OutboundQueue):
+    def __init__(self, writer, loop, metrics):
+        """
+        Queues the packets of an asyncio stream, written by a task on the loop.
+
+        Packets may be sent from the loop or from a worker thread, which hands
+        the wake-up over to the loop.
+
+        Args:
+            writer: The asyncio.StreamWriter of the connection.
+            loop: The event loop serving the connection.
+            metrics: The server Metrics.
+        """
+        super().__init__(metrics)
+        self.writer = writer
+        self.loop = loop
+        self.loop_thread = threading.get_ident()
+        self.ready = asyncio.Event()
+
+    async def write_packets(self):
+        while True:
+            await self.ready.wait()
+            self.ready.clear()
+            data = self.take_packets()
+            if data is None:
+                return
+            if not data:
+                continue
+            try:
+                self.writer.write(data)
+                await self.writer.drain()
+            except (ConnectionError, OSError):
+                self.close()
+                return
+            finally:
+                self.write_started = None
+
+    def getpeername(self):
+        return self.writer.get_extra_info("peername")
+
+    def _wake(self):
+        if threading.get_ident() == self.loop_thread:
+            self.ready.set()
+        else:
+            self.loop.call_soon_threadsafe(self.ready.set)
+
+    def _abort(self):
+        if threading.get_ident() == self.loop_thread:
+            self.writer.transport.abort()
+        else:
+            self.loop.call_soon_threadsafe(self.writer.transport.abort)
@@ -0,0 +1,40 @@
+from concurrent.futures import Future
+
+
+def completed(value):
+    """
+    Returns a Future already resolved to value.
+    """
+    future = Future()
+    future.set_result(value)
+    return future
+
+
+def then(future, func):
+    """
+    Returns a Future resolving to func applied to the result of future, called
+    from the thread completing it. When func returns a Future, the returned
+    one resolves with it. An exception of either is passed on.
+    """
+    chained = Future()
+
+    def complete(done):
+        try:
+            result = func(done.result())
+        except Exception as e:
+            chained.set_exception(e)
+            return
+        if isinstance(result, Future):
+            result.add_done_callback(lambda inner: _copy_result(inner, chained))
+        else:
+            chained.set_result(result)
+
+    future.add_done_callback(complete)
+    return chained
+
+
+def _copy_result(source, target):
+    if source.exception() is not None:
+        target.set_exception(source.exception())
+    else:
+        target.set_result(source.result())
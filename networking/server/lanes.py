@@ -0,0 +1,36 @@
+import threading
+from collections import deque
+
+
+class RequestLanes:
+    def __init__(self, executor):
+        """
+        Runs the jobs of one connection on a shared executor, in order within a
+        lane and concurrently across lanes.
+
+        A lane only ever takes one executor thread: the job running it picks up
+        the next one queued behind it, and the lane is dropped once empty.
+        Jobs handle their own errors, one raising would leave its lane stuck.
+        """
+        self.executor = executor
+        self.lock = threading.Lock()
+        self.lanes = {}
+
+    def submit(self, lane, func, *args):
+        with self.lock:
+            jobs = self.lanes.get(lane)
+            if jobs is not None:
+                jobs.append((func, args))
+                return
+            self.lanes[lane] = deque()
+        self.executor.submit(self.run, lane, func, args)
+
+    def run(self, lane, func, args):
+        while True:
+            func(*args)
+            with self.lock:
+                jobs = self.lanes[lane]
+                if not jobs:
+                    del self.lanes[lane]
+                    return
+                func, args = jobs.popleft()
@@ -1,16 +1,122 @@
+import atexit
 import logging
+import logging.handlers
+import os
+import queue
 import sys
+import threading
+
+from networking import config
+from networking.server.rate_limit import RateLimiter
+
+# Per-packet events, below DEBUG
+TRACE = 5
+logging.addLevelName(TRACE, "TRACE")
+
+_lock = threading.Lock()
+# Handlers added to the root logger, by the process they were added in
+_handlers = []
+_handlers_pid = None
+_listener_pid = None
+
+
+class _QueueHandler(logging.handlers.QueueHandler):
+    def prepare(self, record):
+        # The queue never leaves the process, the listener thread formats the record
+        return record
+
+
+def _install_handlers(log_file):
+    """
+    Logs to stdout and log_file from the calling thread, once per process,
+    replacing the handlers inherited from a parent process.
+    """
+    global _handlers_pid, _listener_pid
+    with _lock:
+        if _handlers_pid == os.getpid():
+            return
+        formatter = logging.Formatter("%(asctime)s - %(levelname)s - %(message)s")
+        handlers = [logging.StreamHandler(sys.stdout), logging.FileHandler(log_file)]
+        for handler in handlers:
+            handler.setFormatter(formatter)
+
+        root = logging.getLogger()
+        for handler in _handlers:
+            root.removeHandler(handler)
+            handler.close()
+        for handler in handlers:
+            root.addHandler(handler)
+        root.setLevel(config.LOG_LEVEL)
+        _handlers[:] = handlers
+        _handlers_pid = os.getpid()
+        _listener_pid = None
+
+
+def _start_listener():
+    """
+    Moves the handlers of _install_handlers behind a queue and a thread
+    writing the records, once per process.
+    """
+    global _listener_pid
+    with _lock:
+        if _listener_pid == os.getpid():
+            return
+        records = queue.SimpleQueue()
+        listener = logging.handlers.QueueListener(records, *_handlers)
+        root = logging.getLogger()
+        for handler in _handlers:
+            root.removeHandler(handler)
+        handler = _QueueHandler(records)
+        root.addHandler(handler)
+        _handlers[:] = [handler]
+
+        listener.start()
+        atexit.register(listener.stop)
+        _listener_pid = os.getpid()
 
 
 class Logger:
     def __init__(self, log_file="server.log"):
+        """
+        Logs to stdout and log_file, from the calling thread until start is
+        called and from a background thread after, callers then only queue the
+        records.
+
+        log_trace is meant for per-packet events and only costs a level check
+        while config.LOG_LEVEL is above TRACE. log_sampled lets through
+        config.LOG_SAMPLE_RATE messages per second of an event type, and
+        tells how many were dropped with the next one.
+        """
         self.log_file = log_file
-        handlers = [logging.StreamHandler(sys.stdout), logging.FileHandler(log_file)]
-        logging.basicConfig(handlers=handlers, level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s")
+        _install_handlers(log_file)
+        self.logger = logging.getLogger()
+        self.sampler = RateLimiter(config.LOG_SAMPLE_RATE, config.LOG_SAMPLE_BURST)
+        self.lock = threading.Lock()
+        self.suppressed = {}
 
+    def start(self):
+        """
+        Starts the logging thread, once the process is done forking.
+        """
+        _start_listener()
 
     def log_event(self, message):
         logging.info(message)
 
     def log_error(self, message):
         logging.error(message)
+
+    def log_trace(self, message, *args):
+        if self.logger.isEnabledFor(TRACE):
+            self.logger.log(TRACE, message, *args)
+
+    def log_sampled(self, event, message, *args, level=logging.ERROR):
+        if not self.sampler.allow(event):
+            with self.lock:
+                self.suppressed[event] = self.suppressed.get(event, 0) + 1
+            return
+        with self.lock:
+            suppressed = self.suppressed.pop(event, 0)
+        if suppressed:
+            message += f" ({suppressed} similar messages suppressed)"
+        self.logger.log(level, message, *args)
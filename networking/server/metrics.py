@@ -0,0 +1,61 @@
+import threading
+
+
+class Summary:
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def add(self, value):
+        self.count += 1
+        self.total += value
+        self.max = max(self.max, value)
+
+    def as_dict(self):
+        return {
+            "count": self.count,
+            "mean": self.total / self.count if self.count else 0.0,
+            "max": self.max,
+        }
+
+
+class Metrics:
+    def __init__(self):
+        """
+        Thread-safe counters, gauges and summaries of the server.
+
+        Counters only go up, gauges hold the last value set along with the
+        highest one seen, summaries keep the count, mean and max of the values
+        observed (durations, queue depths).
+        """
+        self.lock = threading.Lock()
+        self.counters = {}
+        self.gauges = {}
+        self.gauge_peaks = {}
+        self.summaries = {}
+
+    def increment(self, name, amount=1):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + amount
+
+    def set_gauge(self, name, value):
+        with self.lock:
+            self.gauges[name] = value
+            self.gauge_peaks[name] = max(self.gauge_peaks.get(name, value), value)
+
+    def observe(self, name, value):
+        with self.lock:
+            summary = self.summaries.get(name)
+            if summary is None:
+                summary = self.summaries[name] = Summary()
+            summary.add(value)
+
+    def snapshot(self):
+        with self.lock:
+            return {
+                "counters": dict(self.counters),
+                "gauges": {name: {"value": value, "peak": self.gauge_peaks[name]}
+                           for name, value in self.gauges.items()},
+                "summaries": {name: summary.as_dict() for name, summary in self.summaries.items()},
+            }
@@ -6,6 +6,8 @@ class Player:
         self.connection = connection
         self.current_room = None
         self.colour = None
+        self.capabilities = 0
+        self.acknowledged_sequence = None
 
-    def send(self, data):
-        self.connection.sendall(data)
+    def send(self, data, replaceable=False):
+        self.connection.sendall(data, replaceable)
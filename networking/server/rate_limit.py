@@ -0,0 +1,40 @@
+import threading
+import time
+
+from networking import config
+
+
+class RateLimiter:
+    def __init__(self, rate, burst, max_keys=config.RATE_LIMITER_KEYS):
+        """
+        A token bucket per key (an IP address, a username).
+
+        Each bucket holds up to burst tokens and refills at rate tokens per
+        second, every attempt takes one. Only the max_keys buckets used last
+        are kept, forgetting one is the same as refilling it.
+        """
+        self.rate = rate
+        self.burst = burst
+        self.max_keys = max_keys
+        self.lock = threading.Lock()
+        # key -> (tokens, last update), least recently used first
+        self.buckets = {}
+
+    def allow(self, key):
+        """
+        Takes a token from the bucket of key, returns False if it was empty.
+        """
+        now = time.monotonic()
+        with self.lock:
+            bucket = self.buckets.pop(key, None)
+            if bucket is None:
+                tokens = self.burst
+            else:
+                tokens = min(self.burst, bucket[0] + (now - bucket[1]) * self.rate)
+            allowed = tokens >= 1
+            if allowed:
+                tokens -= 1
+            self.buckets[key] = (tokens, now)
+            if len(self.buckets) > self.max_keys:
+                del self.buckets[next(iter(self.buckets))]
+            return allowed
@@ -1,5 +1,10 @@
 import threading
+from collections import OrderedDict, deque
+
 import numpy as np
+
+from networking import config, tlv_definitions
+from networking.tlv_parser import EncodedValue
 from networking.server.round import generate_palette, generate_map
 
 STATE_WAITING = 0x5001
@@ -10,6 +15,8 @@ STATE_PLAYING_FULL = 0x5005
 STATE_PAUSED = 0x5006
 STATE_ENDED = 0x5007
 STATE_CLOSED = 0x5008
+# Moves are accepted in these states
+PLAYING_STATES = (STATE_PLAYING, STATE_PLAYING_FULL)
 
 
 class Room:
@@ -22,9 +29,18 @@ class Room:
         self.players = {}
         self.maze = None
         self.state = STATE_WAITING
-        self.lock = threading.Lock()
+        # Serializes every handler working on the room, reentrant so they can call the methods below
+        self.lock = threading.RLock()
         self.owner = owner
         self.round_number = 0
+        self.sequence = 0
+        self.snapshots = OrderedDict()
+        # Moves waiting for the next tick when the server runs in tick mode
+        self.pending_moves = deque()
+        # Bumped on every change to the room info, invalidates encoded_room_info
+        self.version = 0
+        # (version, encoded room info), replaced as a whole so it can be read without the lock
+        self.encoded_room_info = (None, None)
 
     def add_player(self, player):
         with self.lock:
@@ -35,12 +51,14 @@ class Room:
 
                 if self.current_players == self.max_players:
                     self.state = STATE_FULL if self.state == STATE_WAITING else STATE_PLAYING_FULL
+                self.version += 1
                 return True
         return False
 
     def remove_player(self, player):
         with self.lock:
-            if self.players.get(player.username) is not None:
+            # A stale player must not take out the one that logged in again under its name
+            if self.players.get(player.username) is player:
                 del self.players[player.username]
                 self.current_players -= 1
                 player.current_room = None
@@ -52,6 +70,7 @@ class Room:
                 elif self.state == STATE_PLAYING_FULL:
                     self.state = STATE_PLAYING
 
+                self.version += 1
                 return True
         return False
 
@@ -68,11 +87,40 @@ class Room:
             "min_players": 2,
         }
 
+    def get_encoded_room_info(self):
+        """
+        Returns the room info encoded as a TAG_ROOM value, re-encoding it only
+        when the room changed since the last call. An unchanged room is read
+        without waiting for its lock.
+        """
+        version, encoded_room_info = self.encoded_room_info
+        if version == self.version:
+            return encoded_room_info
+        with self.lock:
+            version, encoded_room_info = self.encoded_room_info
+            if version != self.version:
+                version = self.version
+                encoded_room_info = EncodedValue(tlv_definitions.pack_value(config.TAG_ROOM, self.get_room_info()))
+                self.encoded_room_info = (version, encoded_room_info)
+            return encoded_room_info
+
+    def set_state(self, state):
+        with self.lock:
+            self.state = state
+            self.version += 1
+
     def start_new_round(self):
-        self.round_number += 1
+        with self.lock:
+            self.round_number += 1
+            self.version += 1
 
-    def start_game(self):
-        generated_map = generate_map()
+    def start_game(self, generated_map=None):
+        """
+        Places the players on generated_map, a new map if it is None. Callers
+        holding the lock should generate the map before taking it.
+        """
+        if generated_map is None:
+            generated_map = generate_map()
         self.maze = generated_map.tolist()
         game_info = {
             "map": self.maze,
@@ -87,6 +135,8 @@ class Room:
 
         for player, pos in zip(self.players.values(), game_info["player_positions"]):
             player.x, player.y = pos[0], pos[1]
+            player.acknowledged_sequence = None
+        self.snapshot_positions()
 
         return game_info
 
@@ -94,6 +144,27 @@ class Room:
         for player in self.players.values():
             player.send(data)
 
+    def broadcast_encoded(self, encode):
+        # Encode once per distinct set of negotiated capabilities
+        packets = {}
+        for player in self.players.values():
+            if player.capabilities not in packets:
+                packets[player.capabilities] = encode(player.capabilities)
+            player.send(packets[player.capabilities])
+
+
+    def queue_move(self, username, directions, batched=False, request_id=None):
+        with self.lock:
+            if len(self.pending_moves) >= config.ROOM_MAX_PENDING_MOVES:
+                return False
+            self.pending_moves.append((username, directions, batched, request_id))
+            return True
+
+    def take_moves(self):
+        with self.lock:
+            moves = list(self.pending_moves)
+            self.pending_moves.clear()
+            return moves
 
     def move_player(self, username, direction):
         player = self.players.get(username)
@@ -104,9 +175,7 @@ class Room:
         new_pos = self.calculate_new_position(current_pos, direction)
         if self.is_valid_position(new_pos):
             player.x, player.y = new_pos
-            print("current pos of", username, (player.x, player.y), "new pos", new_pos, "valid")
             return True
-        print("current pos of", username, (player.x, player.y), "new pos", new_pos, "not valid")
 
         return False
 
@@ -130,6 +199,50 @@ class Room:
         positions = [(player.x, player.y) for player in self.players.values()]
         return positions
 
+    def snapshot_positions(self):
+        self.sequence += 1
+        self.snapshots[self.sequence] = self.get_positions_info()
+        while len(self.snapshots) > config.POSITION_HISTORY:
+            self.snapshots.popitem(last=False)
+        return self.sequence
+
+    def get_position_deltas(self, base_sequence):
+        base = self.snapshots.get(base_sequence)
+        current = self.snapshots[self.sequence]
+        if base is None or len(base) != len(current):
+            return None
+
+        deltas = []
+        for index, ((x, y), (base_x, base_y)) in enumerate(zip(current, base)):
+            if (x, y) != (base_x, base_y):
+                if max(abs(x - base_x), abs(y - base_y)) > 127:
+                    return None
+                deltas.append((index, x - base_x, y - base_y))
+        return deltas
+
+    def broadcast_positions(self, encode_snapshot, encode_delta):
+        """
+        Sends the latest snapshot to every player, as a delta against the last
+        snapshot the player acknowledged when it supports them, otherwise (or
+        once its acknowledged snapshot has left the history) in full.
+        """
+        packets = {}
+        for player in self.players.values():
+            base_sequence = None
+            if player.capabilities & config.CAPABILITY_DELTA_POSITIONS:
+                base_sequence = player.acknowledged_sequence
+
+            if base_sequence not in packets:
+                deltas = None if base_sequence is None else self.get_position_deltas(base_sequence)
+                if deltas is None:
+                    if None not in packets:
+                        packets[None] = encode_snapshot(self.sequence, self.snapshots[self.sequence])
+                    packets[base_sequence] = packets[None]
+                else:
+                    packets[base_sequence] = encode_delta(self.sequence, base_sequence, deltas)
+            # A newer snapshot makes the queued ones useless to a lagging player
+            player.send(packets[base_sequence], replaceable=True)
+
 class RoomManager:
     def __init__(self):
         self.rooms = {}
@@ -144,21 +257,25 @@ class RoomManager:
         return False
 
     def join_room(self, room_id, player):
-        with self.lock:
-            if player.current_room is not None:
-                return False
+        if player.current_room is not None:
+            return False
 
-            if room := self.rooms.get(room_id):
-                return room.add_player(player)
+        # The room lock is taken outside the directory lock, rooms never wait on each other
+        with self.lock:
+            room = self.rooms.get(room_id)
+        if room is not None:
+            return room.add_player(player)
         return False
 
     def leave_room(self, player):
         with self.lock:
-            if room := self.rooms.get(player.current_room) is not None:
-                if room.remove_player(player):
-                    if room.state == STATE_CLOSED:
+            room = self.rooms.get(player.current_room)
+        if room is not None and room.remove_player(player):
+            if room.state == STATE_CLOSED:
+                with self.lock:
+                    if self.rooms.get(room.id) is room:
                         del self.rooms[room.id]
-                    return True
+            return True
         return False
 
     def list_rooms(self):
@@ -166,8 +283,14 @@ class RoomManager:
             rooms = [room.get_room_info() for room in self.rooms.values()]
         return rooms
 
+    def list_encoded_rooms(self):
+        with self.lock:
+            rooms = list(self.rooms.values())
+        return [room.get_encoded_room_info() for room in rooms]
+
     def get_room(self, room_id):
-        return self.rooms.get(room_id)
+        with self.lock:
+            return self.rooms.get(room_id)
 
     def set_room_state(self, room_id, state):
         room = self.rooms.get(room_id)
@@ -176,6 +299,6 @@ class RoomManager:
                     STATE_WAITING, STATE_FULL, STATE_STARTING, STATE_PLAYING, STATE_PLAYING_FULL, STATE_PAUSED,
                     STATE_ENDED,
                     STATE_CLOSED):
-                room.state = state
+                room.set_state(state)
                 return True
         return False
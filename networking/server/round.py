@@ -8,6 +8,9 @@ from mazelib.generate import BacktrackingGenerator
 from mazelib.mazelib import Maze
 from mazelib.solve import ShortestPath
 
+MAP_HEIGHTS = range(30, 60, 2)
+MAP_WIDTHS = range(25, 40, 2)
+
 
 def generate_palette(num_colors):
     start_hue = random.random()  # Random starting hue
@@ -31,11 +34,13 @@ def generate_palette(num_colors):
     return colors
 
 
-def generate_map() -> np.matrix:
+def generate_map(height=None, width=None) -> np.matrix:
     maze = Maze()
 
-    height = random.randrange(30, 60, 2)
-    width = random.randrange(25, 40, 2)
+    if height is None:
+        height = random.choice(MAP_HEIGHTS)
+    if width is None:
+        width = random.choice(MAP_WIDTHS)
 
     height /= 2
     width /= 2
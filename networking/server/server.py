@@ -1,21 +1,56 @@
+import asyncio
+import contextlib
 import copy
+import os
+import queue
+import select
 import socket
 import ssl
-import struct
 import threading
+import time
 import traceback
+from concurrent.futures import Future, ThreadPoolExecutor
 
 from networking import config, tlv_definitions
 from auth import AuthenticationService
 from log import Logger
 from networking.server import room
+from networking.server.admission import AdmissionControl
+from networking.server.connection import SocketConnection, StreamConnection
+from networking.server.futures import then
+from networking.server.lanes import RequestLanes
+from networking.server.metrics import Metrics
 from networking.server.player import Player
+from networking.server.rate_limit import RateLimiter
+from networking.server.round import generate_map
 from networking.server.room import RoomManager
+from networking.server.tick import TickScheduler
+from networking.frame_decoder import FrameDecoder
 from networking.tlv_parser import TLVParser
 
 
+ENGINE_THREADS = "threads"
+ENGINE_ASYNCIO = "asyncio"
+
+# Handlers too slow to run on the event loop (map generation), run on the
+# request workers when sent with a request ID. Password hashing happens in the
+# hashing processes, its handlers return a Future of the response
+BLOCKING_PACKETS = (config.REQUEST_START_GAME,)
+
+
 class Server:
-    def __init__(self, host=config.SERVER_IP, port=config.SERVER_PORT, certfile="server.crt", keyfile="server.key"):
+    def __init__(self, host=config.SERVER_IP, port=config.SERVER_PORT, certfile="server.crt", keyfile="server.key",
+                 engine=config.SERVER_ENGINE, tick_rate=config.ROOM_TICK_RATE):
+        """
+        Args:
+            engine: "threads" to serve every client on its own thread, or
+                "asyncio" to serve all of them from a single event loop.
+            tick_rate: Ticks per second of playing rooms, 0 to apply moves as
+                they arrive.
+        """
+        if engine not in (ENGINE_THREADS, ENGINE_ASYNCIO):
+            raise ValueError(f"Unknown server engine: {engine}")
+        self.engine = engine
         self.host = host
         self.port = port
         self.certfile = certfile
@@ -27,9 +62,25 @@ class Server:
         self.auth_service = AuthenticationService()
         self.logger = Logger("logs.txt")
         self.room_manager = RoomManager()
-        self.definitions = tlv_definitions.TLVDefinitions(tag_mappings=tlv_definitions.mappings)
+        self.definitions = tlv_definitions.tag_definitions
         self.tlv_parser = TLVParser(self.definitions)
+        # Guards the client and connection registries only, handlers working on a room hold that room's lock
         self.lock = threading.Lock()
+        self.connections = set()
+        self.loop = None
+        self.async_server = None
+        self.ssl_context = None
+        self.ssl_context_mtimes = None
+        self.metrics = Metrics()
+        self.admission = AdmissionControl(self.metrics)
+        self.ip_limiter = RateLimiter(config.AUTH_RATE_PER_IP, config.AUTH_BURST_PER_IP)
+        self.username_limiter = RateLimiter(config.AUTH_RATE_PER_USERNAME, config.AUTH_BURST_PER_USERNAME)
+        self.tick_scheduler = TickScheduler(self.tick_room, tick_rate, self.logger) if tick_rate else None
+        # Accepted sockets waiting for a handshake worker
+        self.handshake_queue = queue.Queue(maxsize=config.HANDSHAKE_QUEUE_SIZE)
+        self.request_executor = ThreadPoolExecutor(config.REQUEST_WORKERS, thread_name_prefix="request")
+        # Request ID of the request being processed by the current thread, for answers sent later
+        self.request_context = threading.local()
 
         # Mapping packet IDs to their handler functions
         self.handlers = {
@@ -41,14 +92,60 @@ class Server:
             config.REQUEST_CREATE_ROOM: self.handle_create_room,
             config.REQUEST_START_GAME: self.handle_start_game,
             config.REQUEST_MOVE: self.handle_move,
+            config.REQUEST_MOVE_BATCH: self.handle_move_batch,
         }
 
     def start(self):
         self.logger.log_event("Starting server...")
-        self.bind_and_listen()
+        self.auth_service.start_hashing()
+        # The hashing processes are forked, threads may start
+        self.logger.start()
         self.is_listening = True
+        if self.tick_scheduler is not None:
+            self.tick_scheduler.start()
+        threading.Thread(target=self.reap_connections, daemon=True).start()
+        if self.engine == ENGINE_ASYNCIO:
+            started = threading.Event()
+            threading.Thread(target=asyncio.run, args=(self.serve_async(started),)).start()
+            started.wait()
+            return
+        self.bind_and_listen()
+        for _ in range(config.HANDSHAKE_WORKERS):
+            threading.Thread(target=self.handshake_connections, daemon=True).start()
         threading.Thread(target=self.accept_connections).start()
 
+    def get_ssl_context(self):
+        """
+        Returns the server SSLContext, built on the first call.
+
+        The certificate chain is loaded again into the same context when the
+        cert or key file changed on disk, so session tickets issued before the
+        reload stay valid and the asyncio server, which holds on to the
+        context, picks up the new certificate.
+        """
+        mtimes = (os.stat(self.certfile).st_mtime_ns, os.stat(self.keyfile).st_mtime_ns)
+        if self.ssl_context is None:
+            context = ssl.create_default_context(purpose=ssl.Purpose.CLIENT_AUTH)
+            context.load_cert_chain(certfile=self.certfile, keyfile=self.keyfile)
+            context.check_hostname = False
+            # Reconnecting clients resume their session instead of a full handshake
+            context.num_tickets = config.TLS_SESSION_TICKETS
+            self.ssl_context, self.ssl_context_mtimes = context, mtimes
+        elif mtimes != self.ssl_context_mtimes:
+            self.ssl_context_mtimes = mtimes
+            try:
+                self.ssl_context.load_cert_chain(certfile=self.certfile, keyfile=self.keyfile)
+                self.logger.log_event("Reloaded the server certificate")
+            except (OSError, ssl.SSLError) as e:
+                self.logger.log_error(f"Error reloading the server certificate: {e}")
+        return self.ssl_context
+
+    def encode_accepted(self):
+        return self.tlv_parser.encode_tlv_packet(config.ACCEPTED, [
+            (config.TAG_SUCCESS, True),
+            (config.TAG_CAPABILITIES, config.SERVER_CAPABILITIES),
+        ])
+
     def bind_and_listen(self):
         try:
             self.sock.bind((self.host, self.port))
@@ -58,69 +155,308 @@ class Server:
             self.logger.log_error(f"Error binding/listening: {e}")
 
     def accept_connections(self):
+        """
+        Accepts connections and hands them to the handshake workers, so a slow
+        handshake never holds up the next accept.
+        """
         while self.is_listening:
             try:
                 sock, addr = self.sock.accept()
-
-                context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
-                context = ssl.create_default_context(purpose=ssl.Purpose.CLIENT_AUTH)
-                context.load_cert_chain(certfile=self.certfile, keyfile=self.keyfile)
-                context.check_hostname = False
-
-                wrapped_socket = context.wrap_socket(sock, server_side=True)
-
-                payload = [
-                    (config.TAG_SUCCESS, True),
-                ]
-                data = self.tlv_parser.encode_tlv_packet(config.ACCEPTED, payload)
-                wrapped_socket.sendall(data)
-                threading.Thread(target=self.handle_client, args=(wrapped_socket,)).start()
-                self.logger.log_event(f"Connection from {addr}")
             except socket.error as e:
-                self.logger.log_error(f"Error accepting connection: {e}")
+                if self.is_listening:
+                    self.logger.log_error(f"Error accepting connection: {e}")
+                continue
+
+            if not self.admission.admit(addr[0]):
+                self.logger.log_sampled("connection_rejected", "Too many connections, dropping connection from %s",
+                                        addr)
+                sock.close()
+                continue
+
+            # The ACCEPTED packet would otherwise wait behind the session tickets for a delayed ACK
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            try:
+                self.handshake_queue.put_nowait((sock, addr, time.monotonic()))
+                self.metrics.set_gauge("handshake_queue_depth", self.handshake_queue.qsize())
+            except queue.Full:
+                # Every worker is busy and the backlog is full, shed the connection
+                self.metrics.increment("handshakes_rejected")
+                self.logger.log_sampled("handshake_rejected", "Handshake queue full, dropping connection from %s", addr)
+                sock.close()
+                self.admission.release(addr[0])
+
+    def handshake_connections(self):
+        while True:
+            sock, addr, accepted_at = self.handshake_queue.get()
+            self.metrics.set_gauge("handshake_queue_depth", self.handshake_queue.qsize())
+            started_at = time.monotonic()
+            self.metrics.observe("handshake_wait_seconds", started_at - accepted_at)
+            try:
+                sock.setblocking(False)
+                wrapped_socket = self.get_ssl_context().wrap_socket(sock, server_side=True,
+                                                                    do_handshake_on_connect=False)
+                self.do_handshake(wrapped_socket, started_at + config.HANDSHAKE_TIMEOUT)
+                wrapped_socket.setblocking(True)
+            except socket.timeout:
+                self.metrics.increment("handshake_timeouts")
+                self.logger.log_sampled("handshake_failed", "Handshake with %s timed out", addr)
+                sock.close()
+                self.admission.release(addr[0])
+                continue
+            except (OSError, ssl.SSLError) as e:
+                self.metrics.increment("handshake_failures")
+                self.logger.log_sampled("handshake_failed", "Handshake with %s failed: %s", addr, e)
+                sock.close()
+                self.admission.release(addr[0])
+                continue
+            self.metrics.observe("handshake_seconds", time.monotonic() - started_at)
 
-    def handle_client(self, client_socket):
+            try:
+                wrapped_socket.sendall(self.encode_accepted())
+            except OSError as e:
+                self.logger.log_error(f"Error accepting connection: {e}")
+                wrapped_socket.close()
+                self.admission.release(addr[0])
+                continue
+            threading.Thread(target=self.handle_client, args=(wrapped_socket, addr)).start()
+            self.logger.log_event(f"Connection from {addr}")
+
+    @staticmethod
+    def do_handshake(wrapped_socket, deadline):
+        """
+        Runs the handshake of a non-blocking socket, raising socket.timeout
+        once the deadline passes however the client trickles its bytes in.
+        """
+        while True:
+            try:
+                wrapped_socket.do_handshake()
+                return
+            except ssl.SSLWantReadError:
+                readers, writers = [wrapped_socket], []
+            except ssl.SSLWantWriteError:
+                readers, writers = [], [wrapped_socket]
+            remaining = deadline - time.monotonic()
+            if remaining <= 0 or not any(select.select(readers, writers, [], remaining)):
+                raise socket.timeout("Handshake timed out")
+
+    def handle_client(self, client_socket, addr):
+        frame_decoder = FrameDecoder(self.definitions.length_size)
+        # Responses and broadcasts go through the connection's outbound queue
+        connection = SocketConnection(client_socket, self.metrics)
+        connection.ip = addr[0]
+        lanes = RequestLanes(self.request_executor)
+        with self.lock:
+            self.connections.add(connection)
         try:
             while True:
-                raw_packet_length = self.recv_all(client_socket, 2)
-                if not raw_packet_length:
+                frames = frame_decoder.recv_from(client_socket)
+                if frames is None:
                     break
+                connection.received(frame_decoder.has_partial_frame())
+
+                for data in frames:
+                    if (lane := self.pipeline_lane(data)) is not None:
+                        lanes.submit(lane, self.process_pipelined, data, connection)
+                        continue
+                    response = self.process_request(data, connection)
+                    if isinstance(response, Future):
+                        if self.has_request_id(data):
+                            self.send_when_done(response, connection)
+                            continue
+                        response = response.result()
+
+                    # Send the response back to the client, queued moves are answered on the next tick
+                    if response is not None:
+                        connection.sendall(response)
+        except Exception as e:
+            self.logger.log_error(f"Error handling client: {e}, {''.join(traceback.format_tb(e.__traceback__))}")
+        finally:
+            connection.close()
+            client_socket.close()
+            self.client_disconnected(connection)
+            self.admission.release(addr[0])
+
+    async def serve_async(self, started):
+        """
+        Serves every client from one event loop over TLS streams, until stop().
+
+        Requests of a client are processed in order with the same handlers as
+        the threaded engine; the blocking ones run in the default executor, or
+        on the request workers when they carry a request ID.
+        """
+        self.loop = asyncio.get_running_loop()
+        try:
+            self.async_server = await asyncio.start_server(
+                self.handle_client_async, self.host, self.port, ssl=self.get_ssl_context(),
+                ssl_handshake_timeout=config.HANDSHAKE_TIMEOUT, backlog=config.MAX_CLIENTS)
+            self.logger.log_event(f"Server started on {self.host}:{self.port} (asyncio)")
+        except OSError as e:
+            self.logger.log_error(f"Error binding/listening: {e}")
+            return
+        finally:
+            started.set()
 
-                packet_length = struct.unpack("!H", raw_packet_length)[0]
-                data = self.recv_all(client_socket, packet_length - 2)
+        try:
+            async with self.async_server:
+                await self.async_server.serve_forever()
+        except asyncio.CancelledError:
+            pass
+
+    async def handle_client_async(self, reader, writer):
+        ip = writer.get_extra_info("peername")[0]
+        if not self.admission.admit(ip):
+            self.logger.log_sampled("connection_rejected", "Too many connections, dropping connection from %s", ip)
+            writer.transport.abort()
+            return
+        connection = StreamConnection(writer, self.loop, self.metrics)
+        connection.ip = ip
+        with self.lock:
+            self.connections.add(connection)
+        writer_task = asyncio.create_task(connection.write_packets())
+        frame_decoder = FrameDecoder(self.definitions.length_size)
+        lanes = RequestLanes(self.request_executor)
+        self.logger.log_event(f"Connection from {connection.getpeername()}")
+        # Handshakes happen before this point, check for a new certificate for the next ones
+        self.get_ssl_context()
+        try:
+            connection.sendall(self.encode_accepted())
+            while True:
+                data = await reader.read(65536)
                 if not data:
                     break
 
-                response = self.process_request(data, client_socket)
-
-                # Send the response back to the client
-                client_socket.sendall(response)
+                frames = frame_decoder.feed(data)
+                connection.received(frame_decoder.has_partial_frame())
+                for frame in frames:
+                    if (lane := self.pipeline_lane(frame)) is not None:
+                        lanes.submit(lane, self.process_pipelined, frame, connection)
+                        continue
+                    if self.tlv_parser.read_packet_id(frame)[0] in BLOCKING_PACKETS:
+                        response = await self.loop.run_in_executor(None, self.process_request, frame, connection)
+                    else:
+                        response = self.process_request(frame, connection)
+                    if isinstance(response, Future):
+                        if self.has_request_id(frame):
+                            self.send_when_done(response, connection)
+                            continue
+                        response = await asyncio.wrap_future(response)
+                    if response is not None:
+                        connection.sendall(response)
         except Exception as e:
             self.logger.log_error(f"Error handling client: {e}, {''.join(traceback.format_tb(e.__traceback__))}")
         finally:
-            client_socket.close()
+            connection.close()
+            self.client_disconnected(connection)
+            self.admission.release(ip)
+            # Cancelled along with this task when the server stops
+            with contextlib.suppress(asyncio.CancelledError):
+                await writer_task
+            writer.close()
+
+    def client_disconnected(self, connection):
+        """
+        Called once a client connection is closed, with the connection handed
+        to the handlers. Removes the player logged in on it.
+        """
+        with self.lock:
+            self.connections.discard(connection)
+        if connection.player is not None:
+            self.remove_player(connection.player)
+
+    def remove_player(self, player):
+        """
+        Takes a player out of its room and of the client registry, unless it
+        logged in again since.
+        """
+        self.leave_room(player)
+        with self.lock:
+            if self.clients.get(player.username) is player:
+                del self.clients[player.username]
+
+    def reap_connections(self):
+        """
+        Disconnects the clients past the login, idle or read timeout every
+        config.REAPER_INTERVAL seconds.
+        """
+        while self.is_listening:
+            time.sleep(config.REAPER_INTERVAL)
+            now = time.monotonic()
+            with self.lock:
+                connections = list(self.connections)
+            for connection in connections:
+                reason = connection.timed_out(now)
+                if reason is not None:
+                    self.metrics.increment(f"{reason}_timeouts")
+                    self.logger.log_event(f"Closing a connection past the {reason} timeout")
+                    connection.disconnect()
+
+    def pipeline_lane(self, frame):
+        """
+        Returns the packet ID of a slow request carrying a request ID, which is
+        processed without holding up the requests the client sent after it,
+        or None for a request processed in turn.
+        """
+        packet_id = self.tlv_parser.read_packet_id(frame)[0]
+        if packet_id & config.REQUEST_ID_FLAG and packet_id & ~config.REQUEST_ID_FLAG in BLOCKING_PACKETS:
+            return packet_id
+        return None
+
+    def has_request_id(self, frame):
+        return bool(self.tlv_parser.read_packet_id(frame)[0] & config.REQUEST_ID_FLAG)
+
+    def process_pipelined(self, data, connection):
+        # Runs on a request worker, in order with the requests of the same type from the connection
+        try:
+            response = self.process_request(data, connection)
+        except Exception as e:
+            self.logger.log_error(f"Error handling client: {e}, {''.join(traceback.format_tb(e.__traceback__))}")
+            return
+        self.metrics.increment("pipelined_requests")
+        if isinstance(response, Future):
+            self.send_when_done(response, connection)
+        elif response is not None:
+            connection.sendall(response)
+
+    def send_when_done(self, future, connection):
+        """
+        Sends the response a handler returned a Future of once it resolves,
+        without waiting for it.
+        """
+        def send(done):
+            try:
+                response = done.result()
+            except Exception as e:
+                self.logger.log_error(f"Error handling client: {e}, {''.join(traceback.format_tb(e.__traceback__))}")
+                return
+            if response is not None:
+                connection.sendall(response)
 
-    def recv_all(self, client_socket, num_bytes):
-        data = bytearray()
-        while len(data) < num_bytes:
-            packet = client_socket.recv(num_bytes - len(data))
-            if not packet:
-                return None
-            data.extend(packet)
-        return bytes(data)
+        future.add_done_callback(send)
 
     def process_request(self, data, client_socket):
-        offset = 0
+        """
+        Processes a request frame and returns the encoded response, or a
+        Future of it, carrying the request ID of the request if it had one.
+        """
+        data = memoryview(data)
 
         # Extract packet ID
-        packet_id = int.from_bytes(data[offset:offset+self.tlv_parser.tag_definitions.tag_size], byteorder='big')
-        offset += self.tlv_parser.tag_definitions.tag_size
+        packet_id, request_id, offset = self.tlv_parser.read_packet_header(data)
+        self.request_context.request_id = request_id
+
+        response = self.dispatch_request(packet_id, data, offset, client_socket)
+        if response is None or request_id is None:
+            return response
+        if isinstance(response, Future):
+            return then(response, lambda result: self.tlv_parser.add_request_id(result, request_id))
+        return self.tlv_parser.add_request_id(response, request_id)
 
+    def dispatch_request(self, packet_id, data, offset, client_socket):
         if packet_id not in (config.REQUEST_REGISTER, config.REQUEST_LOGIN):
             # Extract JWT token length
             jwt_token, offset = self.tlv_parser.read_tlv(data, offset)
 
-            if not self.auth_service.verify_jwt(jwt_token):
+            if not self.authenticate_request(jwt_token, client_socket):
                 return self.tlv_parser.encode_tlv_packet(config.RESPONSE_AUTH_ERROR,
                                                          [(config.TAG_ERROR_MESSAGE, "Invalid or expired token")])
 
@@ -130,7 +466,7 @@ class Server:
         # Route request based on packet ID
         handler = self.handlers.get(packet_id)
         if handler:
-            if packet_id == config.REQUEST_LOGIN:
+            if packet_id in (config.REQUEST_LOGIN, config.REQUEST_REGISTER):
                 return handler(client_socket=client_socket, *fields)
             return handler(*fields)
         else:
@@ -138,100 +474,179 @@ class Server:
                                                                                                         "packet "
                                                                                                         "ID")])
 
-    def handle_login(self, username, password, client_socket):
-        with self.lock:
-            success, jwt_token = self.auth_service.authenticate_user(username, password)
+    def authenticate_request(self, jwt_token, connection):
+        """
+        Returns the username of a request's token, or None if it is invalid.
+
+        A connection is bound to the last token verified on it, later
+        requests carrying the same token skip the verification until it expires.
+        """
+        session = connection.session
+        if session is not None and session[0] == jwt_token and session[2] >= time.time():
+            return session[1]
+        verified = self.auth_service.verify_session(jwt_token)
+        if verified is None:
+            return None
+        connection.session = (jwt_token, *verified)
+        return verified[0]
+
+    def handle_login(self, username, password, capabilities=0, client_socket=None):
+        if not self.allow_auth_attempt(username, client_socket):
+            return self.encode_rate_limited()
+        authenticated = self.auth_service.authenticate_user(username, password)
+        if authenticated is None:
+            return self.encode_busy()
+
+        def login(result):
+            success, jwt_token = result
             payload = [
                 (config.TAG_SUCCESS, success),
-                (config.TAG_JWT_TOKEN, jwt_token),
             ]
 
             if success:
-                self.clients[username] = Player(username, client_socket)
-        return self.tlv_parser.encode_tlv_packet(config.RESPONSE_LOGIN_RESULT, payload)
-
-    def handle_register(self, username, password):
-        with self.lock:
-            success = self.auth_service.register_user(username, password)
-            payload = [
-                (config.TAG_SUCCESS, success),
-            ]
-        return self.tlv_parser.encode_tlv_packet(config.RESPONSE_REGISTER_RESULT, payload)
+                payload.append((config.TAG_JWT_TOKEN, jwt_token))
+                player = Player(username, client_socket)
+                player.capabilities = capabilities & config.SERVER_CAPABILITIES
+                if client_socket is not None:
+                    client_socket.player = player
+                with self.lock:
+                    self.clients[username] = player
+            return self.tlv_parser.encode_tlv_packet(config.RESPONSE_LOGIN_RESULT, payload)
+
+        return then(authenticated, login)
+
+    def handle_register(self, username, password, client_socket=None):
+        if not self.allow_auth_attempt(username, client_socket):
+            return self.encode_rate_limited()
+        registered = self.auth_service.register_user(username, password)
+        if registered is None:
+            return self.encode_busy()
+        return then(registered, lambda success: self.tlv_parser.encode_tlv_packet(config.RESPONSE_REGISTER_RESULT, [
+            (config.TAG_SUCCESS, success),
+        ]))
+
+    def allow_auth_attempt(self, username, connection):
+        """
+        Takes a login or registration attempt from the buckets of the client's
+        IP address and of the username, returns False if either is empty.
+        """
+        ip = connection.ip if connection is not None else None
+        if ip is not None and not self.ip_limiter.allow(ip):
+            self.metrics.increment("auth_rate_limited_ip")
+            return False
+        if not self.username_limiter.allow(username):
+            self.metrics.increment("auth_rate_limited_username")
+            return False
+        return True
+
+    def encode_rate_limited(self):
+        return self.tlv_parser.encode_tlv_packet(config.RESPONSE_ERROR, [
+            (config.TAG_ERROR_MESSAGE, "Too many attempts, try again later"),
+        ])
+
+    def encode_busy(self):
+        # The hashing processes are too far behind, the client may try again later
+        self.metrics.increment("auth_busy")
+        return self.tlv_parser.encode_tlv_packet(config.RESPONSE_ERROR, [(config.TAG_ERROR_MESSAGE, "Server busy")])
+
+    def encode_not_logged_in(self):
+        # A valid token whose player is gone, e.g. after a reconnect, the client has to log in again
+        return self.tlv_parser.encode_tlv_packet(config.RESPONSE_AUTH_ERROR,
+                                                 [(config.TAG_ERROR_MESSAGE, "Not logged in")])
 
     def handle_join_room(self, username, room_id):
         with self.lock:
-            success = self.room_manager.join_room(room_id, self.clients[username])
-            payload = [
-                (config.TAG_SUCCESS, success),
-            ]
+            player = self.clients.get(username)
+        if player is None:
+            return self.encode_not_logged_in()
 
-            if success:
-                room = self.room_manager.get_room(room_id)
-                room_info = room.get_room_info()
-                payload.append(
-                    (config.TAG_ROOM, room_info)
-                )
-                room.broadcast(self.tlv_parser.encode_tlv_packet(config.SIGNAL_PLAYER_JOIN, payload))
+        success = False
+        payload = [
+            (config.TAG_SUCCESS, success),
+        ]
+        room = self.room_manager.get_room(room_id)
+        if room is not None:
+            with room.lock:
+                success = self.room_manager.join_room(room_id, player)
+                if success:
+                    payload = [
+                        (config.TAG_SUCCESS, success),
+                        (config.TAG_ROOM, room.get_encoded_room_info()),
+                    ]
+                    room.broadcast(self.tlv_parser.encode_tlv_packet(config.SIGNAL_PLAYER_JOIN, payload))
         return self.tlv_parser.encode_tlv_packet(config.RESPONSE_JOIN_ROOM_RESULT, payload)
 
     def handle_leave_room(self, username):
         with self.lock:
-            room_id = username.current_room
-            success = self.room_manager.leave_room(username)
-            payload = [
-                (config.TAG_SUCCESS, success),
-            ]
-            if success:
-                room = self.room_manager.get_room(room_id)
-                room.broadcast(self.tlv_parser.encode_tlv_packet(config.SIGNAL_PLAYER_JOIN, room.get_info))
+            player = self.clients.get(username)
+        if player is None:
+            return self.encode_not_logged_in()
+        success = self.leave_room(player)
+        payload = [
+            (config.TAG_SUCCESS, success),
+        ]
         return self.tlv_parser.encode_tlv_packet(config.RESPONSE_LEAVE_ROOM_RESULT, payload)
 
-    def handle_list_rooms(self, username):
-        with self.lock:
-            rooms = self.room_manager.list_rooms()
-            encoded_rooms = []
-            for room in rooms:
-                room_payload = [
-                    (config.TAG_ROOM, (
-                        (config.TAG_ROOM_ID, room["id"]),
-                        (config.TAG_CURRENT_PLAYERS, room["current_players"]),
-                        (config.TAG_MAX_PLAYERS, room["max_players"]),
-                    ))
-                ]
-                encoded_rooms.append(room_payload)
+    def leave_room(self, player):
+        """
+        Removes the player from its room and sends the updated room to the players left.
+        """
+        r = self.room_manager.get_room(player.current_room)
+        if r is None:
+            return False
+        with r.lock:
+            success = self.room_manager.leave_room(player)
+            if success and r.players:
+                r.broadcast(self.tlv_parser.encode_tlv_packet(config.SIGNAL_PLAYER_JOIN, [
+                    (config.TAG_SUCCESS, True),
+                    (config.TAG_ROOM, r.get_encoded_room_info()),
+                ]))
+        return success
 
-            payload = [
-                (config.TAG_ROOMS, encoded_rooms),
-            ]
+    def handle_list_rooms(self, username):
+        # Assembled from the rooms' cached TAG_ROOM values
+        payload = [
+            (config.TAG_ROOMS, self.room_manager.list_encoded_rooms()),
+        ]
 
         return self.tlv_parser.encode_tlv_packet(config.RESPONSE_LIST_ROOMS_RESULT, payload)
 
     def handle_start_game(self, username, room_id):
         success = False
-        with self.lock:
-            r = self.room_manager.get_room(room_id)
-            if r and r.owner == username:
-                game_info = r.start_game()
+        r = self.room_manager.get_room(room_id)
+        if r and r.owner == username:
+            # Generated before taking the lock, the room stays listable meanwhile
+            generated_map = generate_map()
+            with r.lock:
+                game_info = r.start_game(generated_map)
                 if game_info is None:
                     return self.tlv_parser.encode_tlv_packet(config.RESPONSE_START_GAME_RESULT, [(config.TAG_SUCCESS, False)])
 
-                r.broadcast(self.tlv_parser.encode_tlv_packet(config.SIGNAL_START_GAME, [
-                    (config.TAG_GAME_INFO, game_info),
-                ]
-                ))
+                def encode_start_game(capabilities):
+                    packed_map = bool(capabilities & config.CAPABILITY_PACKED_MAP)
+                    return self.tlv_parser.encode_tlv_packet(config.SIGNAL_START_GAME, [
+                        (config.TAG_GAME_INFO, dict(game_info, packed_map=packed_map)),
+                    ])
+
+                r.broadcast_encoded(encode_start_game)
 
                 self.room_manager.set_room_state(room_id, room.STATE_PLAYING)
+                if self.tick_scheduler is not None:
+                    self.tick_scheduler.schedule(r)
                 success = True
 
-                payload = [
-                    (config.TAG_SUCCESS, success),
-                ]
+        payload = [
+            (config.TAG_SUCCESS, success),
+        ]
 
         return self.tlv_parser.encode_tlv_packet(config.RESPONSE_START_GAME_RESULT, payload)
 
     def handle_create_room(self, username, room_id):
         with self.lock:
-            success = self.room_manager.create_room(room_id, self.clients[username], 4)
+            player = self.clients.get(username)
+        if player is None:
+            return self.encode_not_logged_in()
+        success = self.room_manager.create_room(room_id, player, 4)
 
         payload = [
             (config.TAG_SUCCESS, success),
@@ -240,39 +655,147 @@ class Server:
         if success:
             room = self.room_manager.get_room(room_id)
             payload.append(
-                (config.TAG_ROOM, room.get_room_info())
+                (config.TAG_ROOM, room.get_encoded_room_info())
             )
 
         return self.tlv_parser.encode_tlv_packet(config.RESPONSE_CREATE_ROOM_RESULT, payload)
 
-    def handle_move(self, username, room_id, direction):
+    def handle_move(self, username, room_id, direction, acknowledged_sequence=None):
         success = False
-        with self.lock:
-            r = self.room_manager.get_room(room_id)
-            if r and r.state == room.STATE_PLAYING:
-                if r.players.get(username):
-                    success = r.move_player(username, direction)
-                    if success:
-                        r.broadcast(
-                            self.tlv_parser.encode_tlv_packet(config.SIGNAL_UPDATE_POSITIONS,
-                                                              [(config.TAG_POSITIONS, r.get_positions_info()),]))
-                        px, py = r.players[username].x, r.players[username].y
-                        if r.maze[px][py] == 2:
-                            r.broadcast(
-                                self.tlv_parser.encode_tlv_packet(config.SIGNAL_SCORE_UPDATE,
-                                                                  [(config.TAG_USERNAME, username)])
-                            )
-
-        self.logger.log_event(f"{username} requested a {direction} move, success:{success}")
-        payload = [
-            (config.TAG_SUCCESS, success),
-        ]
+        r = self.room_manager.get_room(room_id)
+        if r:
+            with r.lock:
+                if r.state in room.PLAYING_STATES and r.players.get(username):
+                    if acknowledged_sequence is not None:
+                        r.players[username].acknowledged_sequence = acknowledged_sequence
+                    if self.tick_scheduler is not None:
+                        # Applied and answered on the room's next tick
+                        if r.queue_move(username, (direction,), request_id=self.request_context.request_id):
+                            return None
+                    else:
+                        success = self.apply_move(r, username, direction)
+                        if success:
+                            r.snapshot_positions()
+                            r.broadcast_positions(self.encode_positions_snapshot, self.encode_positions_delta)
+
+        self.logger.log_trace("%s requested a %s move, success:%s", username, direction, success)
+        return tlv_definitions.templates.encode(config.RESPONSE_MOVE_RESULT, success)
+
+    def handle_move_batch(self, username, room_id, moves, acknowledged_sequence=None):
+        """
+        Applies a batch of moves in order and answers them with one result
+        carrying the number of moves that went through.
+        """
+        directions = self.decode_move_batch(moves)
+        success = False
+        applied = 0
+        r = self.room_manager.get_room(room_id)
+        if r and directions is not None:
+            with r.lock:
+                if r.state in room.PLAYING_STATES and r.players.get(username):
+                    if acknowledged_sequence is not None:
+                        r.players[username].acknowledged_sequence = acknowledged_sequence
+                    if self.tick_scheduler is not None:
+                        if r.queue_move(username, directions, batched=True,
+                                        request_id=self.request_context.request_id):
+                            return None
+                    else:
+                        success = True
+                        applied = sum(self.apply_move(r, username, direction) for direction in directions)
+                        if applied:
+                            r.snapshot_positions()
+                            r.broadcast_positions(self.encode_positions_snapshot, self.encode_positions_delta)
+
+        self.logger.log_trace("%s requested %d batched moves, applied:%d", username, len(moves), applied)
+        return tlv_definitions.templates.encode(config.RESPONSE_MOVE_BATCH_RESULT, success, applied)
+
+    @staticmethod
+    def decode_move_batch(moves):
+        """
+        Returns the directions of a batch of (direction, timestamp) moves, or
+        None when the batch is empty, too long, names an unknown direction or
+        has timestamps going back in time.
+        """
+        if not moves or len(moves) > config.MAX_MOVE_BATCH:
+            return None
+        directions = []
+        previous_timestamp = None
+        for code, timestamp in moves:
+            if code >= len(config.DIRECTIONS):
+                return None
+            # Timestamps wrap around at 2**32 milliseconds
+            if previous_timestamp is not None and (timestamp - previous_timestamp) % 2 ** 32 >= 2 ** 31:
+                return None
+            previous_timestamp = timestamp
+            directions.append(config.DIRECTIONS[code])
+        return directions
 
-        return self.tlv_parser.encode_tlv_packet(config.RESPONSE_MOVE_RESULT, payload)
+    def apply_move(self, r, username, direction):
+        success = r.move_player(username, direction)
+        if success:
+            px, py = r.players[username].x, r.players[username].y
+            if r.maze[px][py] == 2:
+                r.broadcast(
+                    self.tlv_parser.encode_tlv_packet(config.SIGNAL_SCORE_UPDATE,
+                                                      [(config.TAG_USERNAME, username)])
+                )
+        return success
+
+    def tick_room(self, r):
+        """
+        Applies the moves queued since the last tick in order, answers them and
+        broadcasts the positions once if any of them succeeded.
+
+        Returns:
+            False once the room stopped playing, to stop ticking it.
+        """
+        with r.lock:
+            if r.state not in room.PLAYING_STATES:
+                return False
+
+            moved = False
+            for username, directions, batched, request_id in r.take_moves():
+                player = r.players.get(username)
+                if player is None:
+                    continue
+                applied = sum(self.apply_move(r, username, direction) for direction in directions)
+                moved = moved or applied > 0
+                if batched:
+                    self.logger.log_trace("%s requested %d batched moves, applied:%d", username, len(directions),
+                                          applied)
+                    response = tlv_definitions.templates.encode(config.RESPONSE_MOVE_BATCH_RESULT, True, applied)
+                else:
+                    self.logger.log_trace("%s requested a %s move, success:%s", username, directions[0], applied > 0)
+                    response = tlv_definitions.templates.encode(config.RESPONSE_MOVE_RESULT, applied > 0)
+                if request_id is not None:
+                    response = self.tlv_parser.add_request_id(response, request_id)
+                player.send(response)
+
+            if moved:
+                r.snapshot_positions()
+                r.broadcast_positions(self.encode_positions_snapshot, self.encode_positions_delta)
+        return True
+
+    def encode_positions_snapshot(self, sequence, positions):
+        return tlv_definitions.templates.encode(config.SIGNAL_UPDATE_POSITIONS, positions, sequence)
+
+    def encode_positions_delta(self, sequence, base_sequence, deltas):
+        return self.tlv_parser.encode_tlv_packet(config.SIGNAL_POSITIONS_DELTA, [
+            (config.TAG_SEQUENCE, sequence),
+            (config.TAG_BASE_SEQUENCE, base_sequence),
+            (config.TAG_POSITION_DELTAS, deltas),
+        ])
 
     def stop(self):
         self.is_listening = False
-        self.sock.close()
+        if self.tick_scheduler is not None:
+            self.tick_scheduler.stop()
+        if self.engine == ENGINE_ASYNCIO:
+            if self.async_server is not None:
+                self.loop.call_soon_threadsafe(self.async_server.close)
+        else:
+            self.sock.close()
+        self.auth_service.close()
         self.logger.log_event("Server stopped")
 
 
@@ -0,0 +1,278 @@
+import itertools
+import multiprocessing
+import socket
+import struct
+import threading
+import traceback
+import zlib
+
+from networking import config
+from networking.frame_decoder import FrameDecoder
+from networking.server.player import Player
+from networking.tlv_parser import EncodedValue
+from server import Server
+
+# Messages between the front process and the shard workers, framed with a
+# 4-byte length prefix (counting itself), a message kind and a connection ID
+LINK_ATTACH = 1
+LINK_DETACH = 2
+LINK_FORWARD = 3
+LINK_DELIVER = 4
+LINK_DELIVER_REPLACEABLE = 5
+LINK_ROOM_INFO = 6
+
+LINK_HEADER = struct.Struct("!IBI")
+ATTACH_HEADER = struct.Struct("!I")
+ROOM_ID_LENGTH = struct.Struct("!H")
+
+# Requests carrying a room ID after the JWT and username, owned by the shard of that room
+ROOM_PACKETS = (config.REQUEST_JOIN_ROOM, config.REQUEST_CREATE_ROOM, config.REQUEST_START_GAME, config.REQUEST_MOVE,
+                config.REQUEST_MOVE_BATCH)
+
+
+class ShardLink:
+    def __init__(self, sock):
+        """
+        One end of the unix socket between the front process and a shard worker.
+        """
+        self.sock = sock
+        self.lock = threading.Lock()
+        self.frame_decoder = FrameDecoder(length_size=4)
+
+    def send(self, kind, connection_id, payload=b""):
+        header = LINK_HEADER.pack(LINK_HEADER.size + len(payload), kind, connection_id)
+        with self.lock:
+            self.sock.sendall(header + payload)
+
+    def receive(self):
+        """
+        Returns the next (kind, connection ID, payload) messages, or None once
+        the other end is gone.
+        """
+        frames = self.frame_decoder.recv_from(self.sock)
+        if frames is None:
+            return None
+        offset = LINK_HEADER.size - 4
+        return [(frame[0], int.from_bytes(frame[1:offset], "big"), memoryview(frame)[offset:]) for frame in frames]
+
+
+class Route:
+    def __init__(self, connection_id):
+        self.connection_id = connection_id
+        # Shards the client was attached to, and the one holding its room
+        self.shards = set()
+        self.room_shard = None
+
+
+class ShardedServer(Server):
+    def __init__(self, *args, workers=config.SHARD_WORKERS, tick_rate=config.ROOM_TICK_RATE, **kwargs):
+        """
+        Terminates TLS and handles logins in this process, while worker
+        processes each own the rooms whose ID hashes to them.
+
+        Requests naming a room are forwarded as they are to the owning worker,
+        whose replies and broadcasts come back over the same link and are
+        queued on the client connection. The front keeps a directory of the
+        encoded room infos the workers publish to answer list requests.
+
+        Args:
+            workers: The number of worker processes.
+            tick_rate: Passed on to the workers, which own the rooms.
+        """
+        super().__init__(*args, tick_rate=0, **kwargs)
+        self.num_workers = workers
+        self.worker_tick_rate = tick_rate
+        self.links = []
+        self.processes = []
+        self.routes = {}
+        self.connections_by_id = {}
+        self.connection_ids = itertools.count(1)
+        self.routes_lock = threading.Lock()
+        self.directory = {}
+        self.directory_lock = threading.Lock()
+
+    def start(self):
+        # Fork before any thread of the front process exists
+        context = multiprocessing.get_context("fork")
+        for index in range(self.num_workers):
+            front_sock, worker_sock = socket.socketpair(socket.AF_UNIX, socket.SOCK_STREAM)
+            process = context.Process(target=run_shard_worker, args=(worker_sock, self.worker_tick_rate), daemon=True)
+            process.start()
+            worker_sock.close()
+            self.links.append(ShardLink(front_sock))
+            self.processes.append(process)
+        self.auth_service.start_hashing()
+        self.logger.start()
+        for link in self.links:
+            threading.Thread(target=self.receive_from_worker, args=(link,), daemon=True).start()
+        self.logger.log_event(f"Started {self.num_workers} shard workers")
+        super().start()
+
+    def stop(self):
+        super().stop()
+        for process in self.processes:
+            process.terminate()
+
+    def shard_for(self, room_id):
+        return zlib.crc32(room_id.encode()) % self.num_workers
+
+    def dispatch_request(self, packet_id, data, offset, client_socket):
+        if packet_id not in ROOM_PACKETS and packet_id != config.REQUEST_LEAVE_ROOM:
+            return super().dispatch_request(packet_id, data, offset, client_socket)
+
+        jwt_token, offset = self.tlv_parser.read_tlv(data, offset)
+        username = self.authenticate_request(jwt_token, client_socket)
+        with self.lock:
+            player = self.clients.get(username)
+        if not username or player is None:
+            return self.tlv_parser.encode_tlv_packet(config.RESPONSE_AUTH_ERROR,
+                                                     [(config.TAG_ERROR_MESSAGE, "Invalid or expired token")])
+
+        with self.routes_lock:
+            route = self.routes.get(client_socket)
+            if route is None:
+                route = self.routes[client_socket] = Route(next(self.connection_ids))
+                self.connections_by_id[route.connection_id] = client_socket
+
+        if packet_id == config.REQUEST_LEAVE_ROOM:
+            shard = route.room_shard
+            if shard is None:
+                return self.tlv_parser.encode_tlv_packet(config.RESPONSE_LEAVE_ROOM_RESULT,
+                                                         [(config.TAG_SUCCESS, False)])
+        else:
+            _, offset = self.tlv_parser.read_tlv(data, offset)
+            room_id, _ = self.tlv_parser.read_tlv(data, offset)
+            shard = self.shard_for(room_id)
+            if packet_id in (config.REQUEST_JOIN_ROOM, config.REQUEST_CREATE_ROOM):
+                route.room_shard = shard
+
+        link = self.links[shard]
+        if shard not in route.shards:
+            # The worker trusts the username checked here, not the one in the request
+            route.shards.add(shard)
+            link.send(LINK_ATTACH, route.connection_id,
+                      ATTACH_HEADER.pack(player.capabilities) + username.encode())
+        # Forwarded with its request ID, the worker answers it
+        link.send(LINK_FORWARD, route.connection_id, data)
+        return None
+
+    def handle_list_rooms(self, username):
+        with self.directory_lock:
+            rooms = list(self.directory.values())
+        return self.tlv_parser.encode_tlv_packet(config.RESPONSE_LIST_ROOMS_RESULT, [(config.TAG_ROOMS, rooms)])
+
+    def client_disconnected(self, connection):
+        super().client_disconnected(connection)
+        with self.routes_lock:
+            route = self.routes.pop(connection, None)
+            if route is None:
+                return
+            del self.connections_by_id[route.connection_id]
+        for shard in route.shards:
+            self.links[shard].send(LINK_DETACH, route.connection_id)
+
+    def receive_from_worker(self, link):
+        while (messages := link.receive()) is not None:
+            for kind, connection_id, payload in messages:
+                if kind == LINK_ROOM_INFO:
+                    self.update_directory(payload)
+                    continue
+                with self.routes_lock:
+                    connection = self.connections_by_id.get(connection_id)
+                if connection is not None:
+                    connection.sendall(payload.tobytes(), kind == LINK_DELIVER_REPLACEABLE)
+        self.logger.log_error("A shard worker exited")
+
+    def update_directory(self, payload):
+        length = ROOM_ID_LENGTH.unpack_from(payload)[0]
+        start = ROOM_ID_LENGTH.size
+        room_id = str(payload[start:start + length], "utf-8")
+        encoded_room_info = payload[start + length:]
+        with self.directory_lock:
+            if encoded_room_info:
+                self.directory[room_id] = EncodedValue(encoded_room_info)
+            else:
+                self.directory.pop(room_id, None)
+
+
+class ProxyConnection:
+    def __init__(self, link, connection_id):
+        """
+        Stands in a shard worker for a client connection held by the front process.
+        """
+        self.link = link
+        self.connection_id = connection_id
+        self.session = None
+
+    def sendall(self, data, replaceable=False):
+        self.link.send(LINK_DELIVER_REPLACEABLE if replaceable else LINK_DELIVER, self.connection_id, data)
+
+
+class ShardWorker(Server):
+    def __init__(self, sock, tick_rate):
+        """
+        Owns a slice of the rooms and runs the regular handlers on the requests
+        the front process forwards, one at a time.
+        """
+        super().__init__(tick_rate=tick_rate)
+        self.link = ShardLink(sock)
+        self.players = {}
+        # Room versions last published to the front process
+        self.published = {}
+
+    def run(self):
+        self.logger.start()
+        if self.tick_scheduler is not None:
+            self.tick_scheduler.start()
+        while (messages := self.link.receive()) is not None:
+            for kind, connection_id, payload in messages:
+                try:
+                    self.handle_link_message(kind, connection_id, payload)
+                except Exception as e:
+                    self.logger.log_error(f"Error handling forwarded request: {e}, "
+                                          f"{''.join(traceback.format_tb(e.__traceback__))}")
+
+    def handle_link_message(self, kind, connection_id, payload):
+        if kind == LINK_ATTACH:
+            capabilities = ATTACH_HEADER.unpack_from(payload)[0]
+            username = str(payload[ATTACH_HEADER.size:], "utf-8")
+            player = Player(username, ProxyConnection(self.link, connection_id))
+            player.capabilities = capabilities
+            self.players[connection_id] = player
+            with self.lock:
+                self.clients[username] = player
+            return
+
+        player = self.players.get(connection_id)
+        if player is None:
+            return
+        room_id = player.current_room
+
+        if kind == LINK_DETACH:
+            del self.players[connection_id]
+            self.remove_player(player)
+        elif kind == LINK_FORWARD:
+            response = self.process_request(payload, player.connection)
+            if response is not None:
+                player.connection.sendall(response)
+
+        for affected_room_id in {room_id, player.current_room} - {None}:
+            self.publish_room(affected_room_id)
+
+    def publish_room(self, room_id):
+        room = self.room_manager.get_room(room_id)
+        version = None if room is None else room.version
+        if self.published.get(room_id) == version:
+            return
+        encoded_room_id = room_id.encode()
+        payload = ROOM_ID_LENGTH.pack(len(encoded_room_id)) + encoded_room_id
+        if room is None:
+            del self.published[room_id]
+        else:
+            self.published[room_id] = version
+            payload += room.get_encoded_room_info()
+        self.link.send(LINK_ROOM_INFO, 0, payload)
+
+
+def run_shard_worker(sock, tick_rate):
+    ShardWorker(sock, tick_rate).run()
@@ -0,0 +1,70 @@
+import heapq
+import itertools
+import threading
+import time
+import traceback
+
+
+class TickScheduler:
+    def __init__(self, tick, rate, logger):
+        """
+        Ticks every scheduled room at a fixed rate from a single thread.
+
+        Rooms wait in a heap ordered by their next tick time, so thousands of
+        them cost one thread and a heap operation per tick.
+
+        Args:
+            tick: Called with a room on each of its ticks, returns False once
+                the room should stop ticking.
+            rate: Ticks per second of every room.
+            logger: Where a failing tick is reported, the room keeps ticking.
+        """
+        self.tick = tick
+        self.logger = logger
+        self.interval = 1.0 / rate
+        self.condition = threading.Condition()
+        self.heap = []
+        self.scheduled = set()
+        self.counter = itertools.count()
+        self.running = False
+
+    def start(self):
+        self.running = True
+        threading.Thread(target=self.run, daemon=True).start()
+
+    def stop(self):
+        with self.condition:
+            self.running = False
+            self.condition.notify()
+
+    def schedule(self, room):
+        with self.condition:
+            if room in self.scheduled:
+                return
+            self.scheduled.add(room)
+            heapq.heappush(self.heap, (time.monotonic() + self.interval, next(self.counter), room))
+            self.condition.notify()
+
+    def run(self):
+        while True:
+            with self.condition:
+                while self.running and (not self.heap or self.heap[0][0] > time.monotonic()):
+                    self.condition.wait(self.heap[0][0] - time.monotonic() if self.heap else None)
+                if not self.running:
+                    return
+                due, _, room = heapq.heappop(self.heap)
+
+            try:
+                keep_ticking = self.tick(room)
+            except Exception as e:
+                self.logger.log_sampled("tick_failed", "Error ticking room %s: %s, %s", room.id, e,
+                                        "".join(traceback.format_tb(e.__traceback__)))
+                keep_ticking = True
+
+            with self.condition:
+                if not keep_ticking:
+                    self.scheduled.discard(room)
+                    continue
+                # A room that fell behind skips the missed ticks instead of bursting through them
+                due = max(due + self.interval, time.monotonic())
+                heapq.heappush(self.heap, (due, next(self.counter), room))
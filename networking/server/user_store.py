@@ -0,0 +1,165 @@
+import abc
+import json
+import os
+import queue
+import sqlite3
+import threading
+from concurrent.futures import Future
+
+from networking import config
+from networking.server.futures import completed
+
+
+class UserStore(abc.ABC):
+    """
+    Where AuthenticationService keeps the user credentials, records being
+    dicts with the "hash" and "salt" of the password as hex.
+    """
+
+    @abc.abstractmethod
+    def get(self, username):
+        """
+        Returns the record of a user, or None.
+        """
+
+    @abc.abstractmethod
+    def put(self, username, record):
+        """
+        Stores the record of a user, returns a Future resolving to True once
+        it is saved.
+        """
+
+    def close(self):
+        pass
+
+
+class JSONUserStore(UserStore):
+    def __init__(self, path="users.json"):
+        """
+        Keeps every user in memory and rewrites the whole file on each change.
+        """
+        self.path = path
+        self.lock = threading.Lock()
+        self.users = {}
+        if os.path.exists(path):
+            with open(path, "r") as f:
+                self.users = json.load(f)
+
+    def get(self, username):
+        return self.users.get(username)
+
+    def put(self, username, record):
+        with self.lock:
+            self.users[username] = record
+            temporary_path = self.path + ".tmp"
+            with open(temporary_path, "w") as f:
+                json.dump(self.users, f)
+            os.replace(temporary_path, self.path)
+        return completed(True)
+
+
+class SQLiteUserStore(UserStore):
+    def __init__(self, path="users.db", legacy_path="users.json"):
+        """
+        Keeps the users in an SQLite database in WAL mode, looked up one
+        record at a time.
+
+        Writes are queued for a single writer thread, which commits all the
+        writes waiting at once in one transaction. The database is opened on
+        first use, importing the users of the JSON file at legacy_path if
+        there is one, which is then renamed with a .migrated suffix.
+        """
+        self.path = path
+        self.legacy_path = legacy_path
+        self.lock = threading.Lock()
+        self.reader = None
+        self.writes = queue.Queue()
+        self.writer_thread = None
+
+    def _open(self):
+        # Called with the lock held
+        if self.reader is not None:
+            return
+        connection = self._connect()
+        connection.execute("CREATE TABLE IF NOT EXISTS users (username TEXT PRIMARY KEY, hash TEXT NOT NULL, "
+                           "salt TEXT NOT NULL)")
+        if self.legacy_path is not None and os.path.exists(self.legacy_path):
+            with open(self.legacy_path, "r") as f:
+                users = json.load(f)
+            with connection:
+                connection.executemany("INSERT OR REPLACE INTO users VALUES (?, ?, ?)",
+                                       [(username, user["hash"], user["salt"]) for username, user in users.items()])
+            os.replace(self.legacy_path, self.legacy_path + ".migrated")
+        self.reader = connection
+        self.writer_thread = threading.Thread(target=self.write_users, daemon=True)
+        self.writer_thread.start()
+
+    def _connect(self):
+        connection = sqlite3.connect(self.path, check_same_thread=False, isolation_level=None)
+        # Readers never wait on the writer, which syncs once per batch of writes
+        connection.execute("PRAGMA journal_mode=WAL")
+        return connection
+
+    def get(self, username):
+        with self.lock:
+            self._open()
+            row = self.reader.execute("SELECT hash, salt FROM users WHERE username = ?", (username,)).fetchone()
+        if row is None:
+            return None
+        return {"hash": row[0], "salt": row[1]}
+
+    def put(self, username, record):
+        with self.lock:
+            self._open()
+        future = Future()
+        self.writes.put((username, record, future))
+        return future
+
+    def write_users(self):
+        connection = self._connect()
+        while True:
+            writes = [self.writes.get()]
+            while len(writes) < config.USER_STORE_BATCH_SIZE:
+                try:
+                    writes.append(self.writes.get_nowait())
+                except queue.Empty:
+                    break
+            closing = writes[-1] is None
+            writes = [write for write in writes if write is not None]
+
+            try:
+                with connection:
+                    connection.execute("BEGIN")
+                    connection.executemany("INSERT OR REPLACE INTO users VALUES (?, ?, ?)",
+                                           [(username, record["hash"], record["salt"])
+                                            for username, record, _ in writes])
+            except sqlite3.Error as e:
+                for _, _, future in writes:
+                    future.set_exception(e)
+            else:
+                for _, _, future in writes:
+                    future.set_result(True)
+
+            if closing:
+                connection.close()
+                return
+
+    def close(self):
+        """
+        Commits the queued writes and stops the writer thread.
+        """
+        with self.lock:
+            if self.writer_thread is None:
+                return
+            self.writes.put(None)
+            self.writer_thread.join()
+            self.reader.close()
+            self.reader = self.writer_thread = None
+
+
+def open_user_store(backend=config.USER_STORE):
+    if backend == "sqlite":
+        return SQLiteUserStore()
+    if backend == "json":
+        return JSONUserStore()
+    raise ValueError(f"Unknown user store: {backend}")
@@ -1,225 +1,12 @@
 import struct
-import copy
+import zlib
 import numpy as np
 
-from networking.server.round import generate_map
-from networking.tlv_parser import TLVParser
+from networking.tlv_parser import PacketTemplates, TLVParser
+from networking.tlv_schema import Codec, Custom, Field, Fixed, Record, Repeated, String
 from networking import config
 
 
-class TLVDefinitions:
-    def __init__(self, tag_size=2, length_size=2, tag_mappings=None):
-        if tag_mappings is None:
-            tag_mappings = dict()
-        self.tag_size = tag_size
-        self.length_size = length_size
-        self.tag_mappings = copy.deepcopy(tag_mappings)
-
-    def get(self, key, default=None):
-        return self.tag_mappings.get(key, default)
-
-
-def unpack_pid(data):
-    return int.from_bytes(data, byteorder='big')
-
-
-def pack_pid(value):
-    return struct.pack("!I", value)
-
-
-def unpack_username(data):
-    return data.decode()
-
-
-def pack_username(value):
-    return value.encode()
-
-
-def unpack_password(data):
-    return data.decode()
-
-
-def pack_password(value):
-    return value.encode()
-
-
-def unpack_jwt_token(data):
-    return data.decode()
-
-
-def pack_jwt_token(value):
-    return value.encode()
-
-
-def unpack_room_id(data):
-    return data.decode()
-
-
-def pack_room_id(value):
-    return value.encode()
-
-
-def unpack_current_players(data):
-    return struct.unpack("!I", data)[0]
-
-
-def pack_current_players(value):
-    return struct.pack("!I", value)
-
-
-def unpack_max_players(data):
-    return struct.unpack("!I", data)[0]
-
-
-def pack_max_players(value):
-    return struct.pack("!I", value)
-
-
-def unpack_success(data):
-    return bool(struct.unpack("!B", data)[0])
-
-
-def pack_success(value):
-    return struct.pack("!B", int(value))
-
-
-def unpack_room(data):
-    parser = TLVParser(tag_definitions)
-    offset = 0
-    room = {}
-    while offset < len(data):
-        tag, value, offset = parser.read_tlv(data, offset, get_tag=True)
-        if tag == config.TAG_ROOM_ID:
-            room["id"] = value
-        elif tag == config.TAG_CURRENT_PLAYERS:
-            room["current_players"] = value
-        elif tag == config.TAG_MAX_PLAYERS:
-            room["max_players"] = value
-        elif tag == config.TAG_PLAYERS:
-            room["players"] = value
-        elif tag == config.TAG_STATE:
-            room["state"] = value
-        elif tag == config.TAG_ROUND:
-            room["round"] = value
-        elif tag == config.TAG_NUM_ROUNDS:
-            room["num_rounds"] = value
-        elif tag == config.TAG_MIN_PLAYERS:
-            room["min_players"] = value
-        elif tag == config.TAG_OWNER:
-            room["owner"] = value
-        else:
-            pass
-    return room
-
-
-def pack_room(value):
-    parser = TLVParser(tag_definitions)
-    packed_room = bytearray()
-
-    encoded_room_id = parser.encode_tlv(config.TAG_ROOM_ID, value["id"])
-    encoded_current_players = parser.encode_tlv(config.TAG_CURRENT_PLAYERS, value["current_players"])
-    encoded_max_players = parser.encode_tlv(config.TAG_MAX_PLAYERS, value["max_players"])
-    encoded_state = parser.encode_tlv(config.TAG_STATE, value["state"])
-    encoded_players = parser.encode_tlv(config.TAG_PLAYERS, value["players"])
-    encoded_round = parser.encode_tlv(config.TAG_ROUND, value["round"])
-    encoded_num_rounds = parser.encode_tlv(config.TAG_NUM_ROUNDS, value["num_rounds"])
-    encoded_min_players = parser.encode_tlv(config.TAG_MIN_PLAYERS, value["min_players"])
-    encoded_owner = parser.encode_tlv(config.TAG_OWNER, value["owner"])
-
-    packed_room.extend(encoded_room_id)
-    packed_room.extend(encoded_current_players)
-    packed_room.extend(encoded_max_players)
-    packed_room.extend(encoded_state)
-    packed_room.extend(encoded_players)
-    packed_room.extend(encoded_round)
-    packed_room.extend(encoded_num_rounds)
-    packed_room.extend(encoded_min_players)
-    packed_room.extend(encoded_owner)
-
-    return packed_room
-
-
-def unpack_rooms(data):
-    parser = TLVParser(tag_definitions)
-    rooms = []
-    offset = 0
-    while offset < len(data):
-        room, offset = parser.read_tlv(data, offset)
-        rooms.append(room)
-    return rooms
-
-
-def pack_rooms(value):
-    parser = TLVParser(tag_definitions)
-    encoded_rooms = bytearray()
-    for room in value:
-        room_data = parser.encode_tlv(config.TAG_ROOM, room)
-        encoded_rooms.extend(room_data)
-    return bytes(encoded_rooms)
-
-
-def unpack_state(data):
-    return struct.unpack("!I", data)[0]
-
-
-def pack_state(value):
-    return struct.pack("!I", value)
-
-
-def unpack_players(data):
-    parser = TLVParser(tag_definitions)
-    players = []
-    offset = 0
-    while offset < len(data):
-        username, offset = parser.read_tlv(data, offset)
-        players.append(username)
-    return players
-
-
-def pack_players(value):
-    parser = TLVParser(tag_definitions)
-    encoded_players = bytearray()
-    for player in value:
-        player_data = parser.encode_tlv(config.TAG_USERNAME, player)
-        encoded_players.extend(player_data)
-    return bytes(encoded_players)
-
-
-def unpack_round(data):
-    return struct.unpack("!I", data)[0]
-
-
-def pack_round(value):
-    return struct.pack("!I", value)
-
-
-def unpack_num_rounds(data):
-    return struct.unpack("!I", data)[0]
-
-
-def pack_num_rounds(value):
-    return struct.pack("!I", value)
-
-
-def unpack_map(data):
-    parser = TLVParser(tag_definitions)
-    maze = []
-    offset = 0
-    while offset < len(data):
-        row, offset = parser.read_tlv(data, offset)
-        maze.append(row)
-    return maze
-
-
-def pack_map(value):
-    parser = TLVParser(tag_definitions)
-    encoded_map = bytearray()
-    for row in value:
-        row_data = parser.encode_tlv(config.TAG_ROW, row)
-        encoded_map.extend(row_data)
-    return bytes(encoded_map)
-
-
 def unpack_row(data):
     ternary_number = int.from_bytes(data, byteorder='big')
     ternary_string = np.base_repr(ternary_number, base=3)
@@ -238,179 +25,188 @@ def pack_row(value):
     return packed_row
 
 
-def unpack_colours(data):
-    parser = TLVParser(tag_definitions)
-    colours = []
-    offset = 0
-    while offset < len(data):
-        colour, offset = parser.read_tlv(data, offset)
-        colours.append(colour)
-    return colours
-
-
-def pack_colours(value):
-    parser = TLVParser(tag_definitions)
-    encoded_colours = bytearray()
-    for colour in value:
-        colour_data = parser.encode_tlv(config.TAG_COLOUR, colour)
-        encoded_colours.extend(colour_data)
-    return bytes(encoded_colours)
-
-
-def unpack_colour(data):
-    data = struct.unpack("!I", data)[0]
-    r = (data >> 16) & 0xFF
-    g = (data >> 8) & 0xFF
-    b = data & 0xFF
-    return (r, g, b)
-
-
-def pack_colour(value):
-    r, g, b = value
-    packed_colour = (r << 16) | (g << 8) | b
-    return struct.pack("!I", packed_colour)
-
-
-def unpack_positions(data):
-    parser = TLVParser(tag_definitions)
-    positions = []
-    offset = 0
-    while offset < len(data):
-        position, offset = parser.read_tlv(data, offset)
-        positions.append(position)
-    return positions
-
-
-def pack_positions(value):
-    parser = TLVParser(tag_definitions)
-    encoded_positions = bytearray()
-    for colour in value:
-        position_data = parser.encode_tlv(config.TAG_POSITION, colour)
-        encoded_positions.extend(position_data)
-    return bytes(encoded_positions)
-
-
-def unpack_position(data):
-    x, y = struct.unpack("!HH", data)
-    return (x, y)
-
-
-def pack_position(value):
-    x, y = value
-    packed_position = struct.pack("!HH", x, y)
-    return packed_position
-
-
-def unpack_game_info(data):
-    parser = TLVParser(tag_definitions)
-    offset = 0
-    game_info = {}
-    while offset < len(data):
-        tag, value, offset = parser.read_tlv(data, offset, get_tag=True)
-        if tag == config.TAG_MAP:
-            game_info["map"] = value
-        elif tag == config.TAG_PLAYER_COLOURS:
-            game_info["player_colours"] = value
-        elif tag == config.TAG_MAP_COLOURS:
-            game_info["map_colours"] = value
-        elif tag == config.TAG_POSITIONS:
-            game_info["player_positions"] = value
-        else:
-            pass
-    return game_info
-
-
-def pack_game_info(value):
-    parser = TLVParser(tag_definitions)
-    packed_info = bytearray()
-
-    encoded_map = parser.encode_tlv(config.TAG_MAP, value["map"])
-    encoded_player_colours = parser.encode_tlv(config.TAG_PLAYER_COLOURS, value["player_colours"])
-    encoded_map_colours = parser.encode_tlv(config.TAG_MAP_COLOURS, value["map_colours"])
-    encoded_player_positions = parser.encode_tlv(config.TAG_POSITIONS, value["player_positions"])
-
-    packed_info.extend(encoded_map)
-    packed_info.extend(encoded_player_colours)
-    packed_info.extend(encoded_map_colours)
-    packed_info.extend(encoded_player_positions)
-
-    return packed_info
-
-
-def unpack_min_players(data):
-    return struct.unpack("!I", data)[0]
-
+def rows_to_grid(rows):
+    # Base-3 rows lose their leading zero cells, so right-align them
+    maze = np.zeros((len(rows), max(map(len, rows), default=0)), dtype=np.int8)
+    for x, row in enumerate(rows):
+        if row:
+            maze[x, -len(row):] = row
+    return maze
 
-def pack_min_players(value):
-    return struct.pack("!I", value)
 
+PACKED_MAP_HEADER = struct.Struct("!HHBB")
+PACKED_MAP_ZLIB = 0x01
+
+
+def _cell_shifts(cell_bits):
+    cells_per_byte = 8 // cell_bits
+    return np.arange(cells_per_byte - 1, -1, -1, dtype=np.uint8) * cell_bits
+
+
+def unpack_packed_map(data):
+    height, width, cell_bits, flags = PACKED_MAP_HEADER.unpack_from(data)
+    if cell_bits not in (1, 2, 4, 8):
+        raise ValueError(f"Unsupported cell size: {cell_bits} bits")
+
+    payload = data[PACKED_MAP_HEADER.size:]
+    if flags & PACKED_MAP_ZLIB:
+        payload = zlib.decompress(payload)
+
+    packed = np.frombuffer(payload, dtype=np.uint8)
+    cells = (packed[:, None] >> _cell_shifts(cell_bits)) & ((1 << cell_bits) - 1)
+    if cells.size < height * width:
+        raise ValueError(f"Incomplete data: {cells.size} cells for a {height}x{width} map")
+    return cells.reshape(-1)[:height * width].reshape(height, width).astype(np.int8)
+
+
+def pack_packed_map(value):
+    grid = np.asarray(value, dtype=np.uint8)
+    height, width = grid.shape
+
+    highest = int(grid.max()) if grid.size else 0
+    cell_bits = next(bits for bits in (2, 4, 8) if highest < 1 << bits)
+    shifts = _cell_shifts(cell_bits)
+
+    cells = grid.reshape(-1)
+    padding = (-cells.size) % len(shifts)
+    if padding:
+        cells = np.concatenate((cells, np.zeros(padding, dtype=np.uint8)))
+    payload = np.bitwise_or.reduce(cells.reshape(-1, len(shifts)) << shifts, axis=1).astype(np.uint8).tobytes()
+
+    flags = 0
+    if config.MAP_COMPRESSION_LEVEL:
+        compressed = zlib.compress(payload, config.MAP_COMPRESSION_LEVEL)
+        if len(compressed) < len(payload):
+            payload, flags = compressed, flags | PACKED_MAP_ZLIB
+
+    return PACKED_MAP_HEADER.pack(height, width, cell_bits, flags) + payload
+
+
+POSITION_DELTA = struct.Struct("!Bbb")
+
+
+def unpack_position_deltas(data):
+    records = np.frombuffer(data, dtype=np.uint8).reshape(-1, POSITION_DELTA.size)
+    return np.column_stack((records[:, 0], records[:, 1:].view(np.int8))).astype(np.int32)
+
+
+def pack_position_deltas(value):
+    return b"".join(POSITION_DELTA.pack(index, dx, dy) for index, dx, dy in value)
+
+
+U32 = Fixed("!I")
+BOOL = Fixed("!B", pack=int, unpack=bool)
+STRING = String()
+# Colours travel as a 32-bit 0x00RRGGBB integer
+COLOUR = Fixed("!xBBB")
+COLOURS = Repeated(config.TAG_COLOUR, dtype=np.uint8)
+
+tags = {
+    config.ACCEPTED: U32,
+    config.TAG_USERNAME: STRING,
+    config.TAG_PASSWORD: STRING,
+    config.TAG_JWT_TOKEN: STRING,
+    config.TAG_ROOM_ID: STRING,
+    config.TAG_CURRENT_PLAYERS: U32,
+    config.TAG_MAX_PLAYERS: U32,
+    config.TAG_MIN_PLAYERS: U32,
+    config.TAG_OWNER: STRING,
+    config.TAG_STATE: U32,
+    config.TAG_SUCCESS: BOOL,
+    config.TAG_ROOM: Record(
+        Field("id", config.TAG_ROOM_ID),
+        Field("current_players", config.TAG_CURRENT_PLAYERS),
+        Field("max_players", config.TAG_MAX_PLAYERS),
+        Field("state", config.TAG_STATE),
+        Field("players", config.TAG_PLAYERS),
+        Field("round", config.TAG_ROUND),
+        Field("num_rounds", config.TAG_NUM_ROUNDS),
+        Field("min_players", config.TAG_MIN_PLAYERS),
+        Field("owner", config.TAG_OWNER),
+    ),
+    config.TAG_ROOMS: Repeated(config.TAG_ROOM),
+    config.TAG_ROUND: U32,
+    config.TAG_NUM_ROUNDS: U32,
+    config.TAG_PLAYERS: Repeated(config.TAG_USERNAME),
+    config.TAG_MAP: Repeated(config.TAG_ROW, finish=rows_to_grid),
+    config.TAG_ROW: Custom(pack_row, unpack_row),
+    config.TAG_PACKED_MAP: Custom(pack_packed_map, unpack_packed_map),
+    config.TAG_COLOURS: COLOURS,
+    config.TAG_COLOUR: COLOUR,
+    config.TAG_POSITIONS: Repeated(config.TAG_POSITION, dtype=np.int32),
+    config.TAG_POSITION: Fixed("!HH"),
+    config.TAG_GAME_INFO: Record(
+        # Peers that negotiated CAPABILITY_PACKED_MAP get the whole grid in one TLV
+        Field("map", config.TAG_MAP, variant=("packed_map", config.TAG_PACKED_MAP)),
+        Field("player_colours", config.TAG_PLAYER_COLOURS),
+        Field("map_colours", config.TAG_MAP_COLOURS),
+        Field("player_positions", config.TAG_POSITIONS),
+    ),
+    config.TAG_PLAYER_COLOURS: COLOURS,
+    config.TAG_MAP_COLOURS: COLOURS,
+    config.TAG_DIRECTION: STRING,
+    config.TAG_CAPABILITIES: U32,
+    config.TAG_SEQUENCE: U32,
+    config.TAG_BASE_SEQUENCE: U32,
+    config.TAG_POSITION_DELTAS: Custom(pack_position_deltas, unpack_position_deltas),
+    config.TAG_MOVES: Repeated(config.TAG_MOVE),
+    config.TAG_MOVE: Fixed("!BI"),
+    config.TAG_MOVES_APPLIED: U32,
+
+    config.TAG_ERROR_MESSAGE: STRING,
+}
 
-def unpack_owner(data):
-    return data.decode()
+codec = Codec(tags)
+mappings = codec.tag_mappings
 
 
-def pack_owner(value):
-    return value.encode()
+def pack_value(tag, value):
+    return mappings[tag]["pack_func"](value)
 
 
-def unpack_direction(data):
-    return data.decode()
+def unpack_value(tag, data):
+    return mappings[tag]["unpack_func"](data)
 
 
-def pack_direction(value):
-    return value.encode()
+tag_definitions = codec
 
+# Initialize the parser
+parser = TLVParser(tag_definitions)
 
-def pack_colour(value):
-    r, g, b = value
-    packed_colour = (r << 16) | (g << 8) | b
-    return struct.pack("!I", packed_colour)
 
+def move_request_layout(jwt_token, username, room_id, direction, acknowledged_sequence=None):
+    layout = (
+        ("const", config.TAG_JWT_TOKEN, jwt_token),
+        ("const", config.TAG_USERNAME, username),
+        ("const", config.TAG_ROOM_ID, room_id),
+        ("const", config.TAG_DIRECTION, direction),
+    )
+    if acknowledged_sequence is None:
+        return layout, ()
+    return layout + (("var", config.TAG_SEQUENCE, "I"),), (acknowledged_sequence,)
 
-def unpack_error_message(data):
-    return data.decode()
 
+def move_result_layout(success):
+    return (("const", config.TAG_SUCCESS, success),), ()
 
-def pack_error_message(value):
-    return value.encode()
 
+def move_batch_result_layout(success, applied):
+    return (("const", config.TAG_SUCCESS, success), ("var", config.TAG_MOVES_APPLIED, "I")), (applied,)
 
-mappings = {
-    config.ACCEPTED: {"unpack_func": unpack_pid, "pack_func": pack_pid},
-    config.TAG_USERNAME: {"unpack_func": unpack_username, "pack_func": pack_username},
-    config.TAG_PASSWORD: {"unpack_func": unpack_password, "pack_func": pack_password},
-    config.TAG_JWT_TOKEN: {"unpack_func": unpack_jwt_token, "pack_func": pack_jwt_token},
-    config.TAG_ROOM_ID: {"unpack_func": unpack_room_id, "pack_func": pack_room_id},
-    config.TAG_CURRENT_PLAYERS: {"unpack_func": unpack_current_players, "pack_func": pack_current_players},
-    config.TAG_MAX_PLAYERS: {"unpack_func": unpack_max_players, "pack_func": pack_max_players},
-    config.TAG_MIN_PLAYERS: {"unpack_func": unpack_min_players, "pack_func": pack_min_players},
-    config.TAG_OWNER: {"unpack_func": unpack_owner, "pack_func": pack_owner},
-    config.TAG_STATE: {"unpack_func": unpack_state, "pack_func": pack_state},
-    config.TAG_SUCCESS: {"unpack_func": unpack_success, "pack_func": pack_success},
-    config.TAG_ROOM: {"unpack_func": unpack_room, "pack_func": pack_room},
-    config.TAG_ROOMS: {"unpack_func": unpack_rooms, "pack_func": pack_rooms},
-    config.TAG_ROUND: {"unpack_func": unpack_round, "pack_func": pack_round},
-    config.TAG_NUM_ROUNDS: {"unpack_func": unpack_num_rounds, "pack_func": pack_num_rounds},
-    config.TAG_PLAYERS: {"unpack_func": unpack_players, "pack_func": pack_players},
-    config.TAG_MAP: {"unpack_func": unpack_map, "pack_func": pack_map},
-    config.TAG_ROW: {"unpack_func": unpack_row, "pack_func": pack_row},
-    config.TAG_COLOURS: {"unpack_func": unpack_colours, "pack_func": pack_colours},
-    config.TAG_COLOUR: {"unpack_func": unpack_colour, "pack_func": pack_colour},
-    config.TAG_POSITIONS: {"unpack_func": unpack_positions, "pack_func": pack_positions},
-    config.TAG_POSITION: {"unpack_func": unpack_position, "pack_func": pack_position},
-    config.TAG_GAME_INFO: {"unpack_func": unpack_game_info, "pack_func": pack_game_info},
-    config.TAG_PLAYER_COLOURS: {"unpack_func": unpack_colours, "pack_func": pack_colours},
-    config.TAG_MAP_COLOURS: {"unpack_func": unpack_colours, "pack_func": pack_colours},
-    config.TAG_DIRECTION: {"unpack_func": unpack_direction, "pack_func": pack_direction},
 
-    config.TAG_ERROR_MESSAGE: {"unpack_func": unpack_error_message, "pack_func": pack_error_message},
-}
+def update_positions_layout(positions, sequence):
+    return (
+        ("repeat", config.TAG_POSITIONS, config.TAG_POSITION, "HH", len(positions)),
+        ("var", config.TAG_SEQUENCE, "I"),
+    ), (positions, sequence)
 
-# Usage example (assuming read_tlv function is defined elsewhere)
-tag_definitions = TLVDefinitions(tag_mappings=mappings)
 
-# Initialize the parser
-parser = TLVParser(tag_definitions)
+# Precompiled encoders for the packets sent on every move
+templates = PacketTemplates(tag_definitions)
+templates.register(config.REQUEST_MOVE, move_request_layout)
+templates.register(config.RESPONSE_MOVE_RESULT, move_result_layout)
+templates.register(config.RESPONSE_MOVE_BATCH_RESULT, move_batch_result_layout)
+templates.register(config.SIGNAL_UPDATE_POSITIONS, update_positions_layout)
 
 '''
 # Sample rooms data
@@ -436,11 +232,11 @@ rooms = [
 ]
 
 # Packing rooms
-packed_rooms = pack_rooms(rooms)
+packed_rooms = pack_value(config.TAG_ROOMS, rooms)
 print(packed_rooms.hex().upper())
 
 # Unpacking rooms
-unpacked_rooms = unpack_rooms(packed_rooms)
+unpacked_rooms = unpack_value(config.TAG_ROOMS, packed_rooms)
 
 # Printing unpacked rooms
 for room in unpacked_rooms:
@@ -1,14 +1,35 @@
 import struct
+import threading
+from collections import OrderedDict
+
+from networking import config
+
+_SIZE_FORMATS = {1: "B", 2: "H", 4: "I"}
+_REQUEST_ID = struct.Struct("!I")
+
+
+class EncodedValue(bytes):
+    """
+    A TLV value that has already been encoded, written as-is instead of going
+    through the pack or write function of its tag.
+    """
 
 
 class TLVParser:
     def __init__(self, tag_definitions):
         self.tag_definitions = tag_definitions
+        self.header = struct.Struct("!" + _SIZE_FORMATS[tag_definitions.tag_size]
+                                    + _SIZE_FORMATS[tag_definitions.length_size])
+        self.local = threading.local()
 
     def read_tlv(self, data, offset, get_tag=False):
         """
         Reads a single TLV element from the data stream.
 
+        When data is a memoryview the value handed to the unpack function is a
+        view over the same buffer, so nested containers are decoded without
+        copying; only the leaf values create new objects.
+
         Args:
             data: The byte stream containing the TLV data.
             offset: The current offset within the data stream.
@@ -20,23 +41,14 @@ class TLVParser:
             ValueError: If the data format is invalid or an unknown tag is encountered.
             :param get_tag:
         """
-        # Read tag size from configuration
-        tag_size = self.tag_definitions.tag_size
+        header_size = self.header.size
 
-        if len(data) < offset + tag_size:
-            raise ValueError("Incomplete data: Tag missing")
-
-        tag = int.from_bytes(data[offset:offset + tag_size], byteorder='big')
-        offset += tag_size
+        if len(data) < offset + header_size:
+            raise ValueError("Incomplete data: Tag or length missing")
 
-        # Read length size from configuration
-        length_size = self.tag_definitions.length_size
+        tag, length = self.header.unpack_from(data, offset)
+        offset += header_size
 
-        if len(data) < offset + length_size:
-            raise ValueError("Incomplete data: Length missing")
-
-        length = int.from_bytes(data[offset:offset + length_size], byteorder='big')
-        offset += length_size
         if len(data) < offset + length:
             raise ValueError(f"Incomplete data: Value length {length} exceeds remaining data {len(data)}")
 
@@ -55,6 +67,62 @@ class TLVParser:
 
         return value, offset
 
+    def read_packet_id(self, data, offset=0):
+        """
+        Reads the packet ID at the start of a frame.
+
+        Returns:
+            A tuple containing the packet ID and the updated offset.
+        """
+        tag_size = self.tag_definitions.tag_size
+        if len(data) < offset + tag_size:
+            raise ValueError("Incomplete data: Packet ID missing")
+        return int.from_bytes(data[offset:offset + tag_size], byteorder='big'), offset + tag_size
+
+    def read_packet_header(self, data, offset=0):
+        """
+        Reads the packet ID at the start of a frame and the request ID
+        following it when the packet ID has config.REQUEST_ID_FLAG set.
+
+        Returns:
+            A tuple containing the packet ID without the flag, the request ID
+            or None, and the updated offset.
+        """
+        packet_id, offset = self.read_packet_id(data, offset)
+        if not packet_id & config.REQUEST_ID_FLAG:
+            return packet_id, None, offset
+        if len(data) < offset + _REQUEST_ID.size:
+            raise ValueError("Incomplete data: Request ID missing")
+        request_id = _REQUEST_ID.unpack_from(data, offset)[0]
+        return packet_id & ~config.REQUEST_ID_FLAG, request_id, offset + _REQUEST_ID.size
+
+    def add_request_id(self, packet, request_id):
+        """
+        Returns an encoded packet (length prefix included) with the request ID
+        added to its header.
+        """
+        length_size = self.tag_definitions.length_size
+        tag_size = self.tag_definitions.tag_size
+        end = length_size + tag_size
+        length = int.from_bytes(packet[:length_size], byteorder='big') + _REQUEST_ID.size
+        packet_id = int.from_bytes(packet[length_size:end], byteorder='big') | config.REQUEST_ID_FLAG
+        return b"".join((length.to_bytes(length_size, byteorder='big'), packet_id.to_bytes(tag_size, byteorder='big'),
+                         _REQUEST_ID.pack(request_id), packet[end:]))
+
+    def parse_packet(self, data):
+        """
+        Parses a received frame (packet ID followed by TLV fields).
+
+        The frame is wrapped in a single memoryview which every nested
+        container decodes from, instead of slicing a new bytes object per level.
+
+        Returns:
+            A tuple containing the packet ID and the list of parsed fields.
+        """
+        view = memoryview(data)
+        packet_id, offset = self.read_packet_id(view)
+        return packet_id, self.parse_tlv(view, offset)
+
     def parse_tlv(self, data, offset):
         """
         Parses a complete TLV stream.
@@ -93,28 +161,243 @@ class TLVParser:
         """
         Encodes a TLV packet.
 
+        The packet is serialized by a TLVWriter whose buffer is kept per thread,
+        so each connection handler reuses the same buffer for every packet it sends.
+
         Args:
             packet_id: The ID of the packet.
             fields: A list of tuples containing tag and value.
 
         Returns:
-            The encoded TLV packet as a byte array.
+            The encoded TLV packet as bytes.
+        """
+        writer = getattr(self.local, "writer", None)
+        if writer is None:
+            writer = self.local.writer = TLVWriter(self.tag_definitions)
+        return writer.write_packet(packet_id, fields)
+
+
+class TLVWriter:
+    def __init__(self, tag_definitions, buffer_size=4096):
+        """
+        Serializes a whole packet into one growable buffer.
+
+        Containers reserve their length slot when they are opened and patch it
+        once they are closed, so nested values are never copied into their parent.
+
+        Args:
+            tag_definitions: The tag definitions used to look up pack and write functions.
+            buffer_size: The initial size of the buffer.
+        """
+        self.tag_definitions = tag_definitions
+        self.header = struct.Struct("!" + _SIZE_FORMATS[tag_definitions.tag_size]
+                                    + _SIZE_FORMATS[tag_definitions.length_size])
+        self.length = struct.Struct("!" + _SIZE_FORMATS[tag_definitions.length_size])
+        self.buffer = bytearray(buffer_size)
+        self.position = 0
+        self.containers = []
+
+    def reset(self):
+        self.position = 0
+        self.containers.clear()
+
+    def getvalue(self):
+        with memoryview(self.buffer) as view:
+            return view[:self.position].tobytes()
+
+    def reserve(self, num_bytes):
+        shortfall = self.position + num_bytes - len(self.buffer)
+        if shortfall > 0:
+            self.buffer.extend(bytes(max(shortfall, len(self.buffer))))
+
+    def write(self, data):
+        end = self.position + len(data)
+        self.buffer[self.position:end] = data
+        self.position = end
+
+    def write_struct(self, fmt, *values):
+        """
+        Writes values packed with a precompiled struct.Struct.
+        """
+        self.reserve(fmt.size)
+        fmt.pack_into(self.buffer, self.position, *values)
+        self.position += fmt.size
+
+    def begin_packet(self, packet_id):
+        self.reserve(self.length.size + self.tag_definitions.tag_size)
+        # Packet lengths count their own prefix
+        self.containers.append((self.position, self.position))
+        self.position += self.length.size
+        self.buffer[self.position:self.position + self.tag_definitions.tag_size] = \
+            packet_id.to_bytes(self.tag_definitions.tag_size, byteorder='big')
+        self.position += self.tag_definitions.tag_size
+
+    def begin(self, tag):
+        self.reserve(self.header.size)
+        self.header.pack_into(self.buffer, self.position, tag, 0)
+        self.position += self.header.size
+        self.containers.append((self.position - self.length.size, self.position))
+
+    def end(self):
+        """
+        Closes the innermost container or packet and patches its length slot.
+        """
+        slot, start = self.containers.pop()
+        length = self.position - start
+        try:
+            self.length.pack_into(self.buffer, slot, length)
+        except struct.error:
+            raise ValueError(f"Value length {length} does not fit in the length field")
+
+    def write_tlv(self, tag, value):
+        definition = self.tag_definitions.get(tag)
+        if definition is None:
+            raise ValueError(f"Unknown tag: {tag}")
+
+        if type(value) is EncodedValue:
+            encoded_value = value
+        elif write_func := definition.get("write_func"):
+            self.begin(tag)
+            write_func(self, value)
+            self.end()
+            return
+        else:
+            encoded_value = definition["pack_func"](value)
+        self.write_encoded(tag, encoded_value)
+
+    def write_encoded(self, tag, encoded_value):
+        """
+        Writes a TLV whose value is already encoded.
+        """
+        self.reserve(self.header.size)
+        try:
+            self.header.pack_into(self.buffer, self.position, tag, len(encoded_value))
+        except struct.error:
+            raise ValueError(f"Value length {len(encoded_value)} does not fit in the length field")
+        self.position += self.header.size
+        self.write(encoded_value)
+
+    def write_packet(self, packet_id, fields):
         """
-        packet = bytearray()
-        packet.extend(struct.pack("!H", packet_id))
+        Encodes a complete packet, length prefix included, and returns it as bytes.
+        """
+        self.reset()
+        self.begin_packet(packet_id)
         for tag, value in fields:
-            packet.extend(self.encode_tlv(tag, value))
+            self.write_tlv(tag, value)
+        self.end()
+        return self.getvalue()
+
+
+class PacketTemplate:
+    def __init__(self, tag_definitions, packet_id, layout):
+        """
+        A packet whose size is known up front, encoded with a single struct call.
+
+        Constant fields, TLV headers and the length prefix are encoded once;
+        encoding only fills in the variable values.
+
+        Args:
+            tag_definitions: The tag definitions used to encode the constant fields.
+            packet_id: The ID of the packet.
+            layout: A sequence of fields, each one of
+                ("const", tag, value): a field encoded once,
+                ("var", tag, fmt): a fixed-size field packed with the struct format fmt,
+                ("repeat", tag, element_tag, fmt, count): a container of count
+                fixed-size elements, filled from a sequence of tuples.
+        """
+        length_format = _SIZE_FORMATS[tag_definitions.length_size]
+        tag_format = _SIZE_FORMATS[tag_definitions.tag_size]
+        header_size = tag_definitions.tag_size + tag_definitions.length_size
+        writer = TLVWriter(tag_definitions, buffer_size=256)
+
+        fmt = ["!", length_format, tag_format]
+        args = [0, packet_id]
+        self.fillers = []
+        for field in layout:
+            kind, tag = field[0], field[1]
+            if kind == "const":
+                writer.reset()
+                writer.write_tlv(tag, field[2])
+                encoded = writer.getvalue()
+                fmt.append(f"{len(encoded)}s")
+                args.append(encoded)
+            elif kind == "var":
+                value_format = field[2]
+                fmt.append(tag_format + length_format + value_format)
+                args += [tag, struct.calcsize("!" + value_format)]
+                self.fillers.append(_var_filler(len(args), len(value_format)))
+                args += [0] * len(value_format)
+            elif kind == "repeat":
+                element_tag, value_format, count = field[2:]
+                value_size = struct.calcsize("!" + value_format)
+                fmt.append(tag_format + length_format + (tag_format + length_format + value_format) * count)
+                args += [tag, (header_size + value_size) * count]
+                self.fillers.append(_repeat_filler(len(args) + 2, len(value_format), count))
+                args += [element_tag, value_size, *[0] * len(value_format)] * count
+            else:
+                raise ValueError(f"Unknown template field: {kind}")
+
+        self.struct = struct.Struct("".join(fmt))
+        args[0] = self.struct.size
+        self.args = args
+        self.packet = self.struct.pack(*args) if not self.fillers else None
 
-        return struct.pack("!H", len(packet) + 2) + packet
+    def encode(self, values):
+        if self.packet is not None:
+            return self.packet
+        args = self.args.copy()
+        for fill, value in zip(self.fillers, values):
+            fill(args, value)
+        return self.struct.pack(*args)
 
 
-class TLVDefinitions:
-    def __init__(self, tag_size=2, length_size=2, tag_mappings=None):
-        if tag_mappings is None:
-            tag_mappings = dict()
-        self.tag_size = tag_size
-        self.length_size = length_size
-        self.tag_mappings = tag_mappings
+def _var_filler(index, num_fields):
+    if num_fields == 1:
+        def fill(args, value):
+            args[index] = value
+    else:
+        def fill(args, value):
+            args[index:index + num_fields] = value
+    return fill
+
+
+def _repeat_filler(start, num_fields, count):
+    stride = num_fields + 2
+    stop = start + stride * count
+
+    def fill(args, values):
+        if len(values) != count:
+            raise ValueError(f"Expected {count} elements, got {len(values)}")
+        for i, column in enumerate(zip(*values)):
+            args[start + i:stop:stride] = column
+    return fill
+
+
+class PacketTemplates:
+    def __init__(self, tag_definitions, max_templates=1024):
+        """
+        A registry of precompiled packet templates for hot packets.
+
+        Each registered packet has a layout function that maps the encode
+        arguments to a hashable layout and the tuple of variable values. The
+        template built for a layout is kept (up to max_templates of them) and
+        reused for every packet with the same layout.
+        """
+        self.tag_definitions = tag_definitions
+        self.max_templates = max_templates
+        self.layouts = {}
+        self.templates = OrderedDict()
+
+    def register(self, packet_id, layout):
+        self.layouts[packet_id] = layout
 
-    def get(self, key, default=None):
-        return self.tag_mappings.get(key, default)
+    def encode(self, packet_id, *args):
+        layout, values = self.layouts[packet_id](*args)
+        key = (packet_id, layout)
+        template = self.templates.get(key)
+        if template is None:
+            template = self.templates[key] = PacketTemplate(self.tag_definitions, packet_id, layout)
+            if len(self.templates) > self.max_templates:
+                self.templates.popitem(last=False)
+        return template.encode(values)
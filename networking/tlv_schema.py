@@ -0,0 +1,336 @@
+import struct
+
+import numpy as np
+
+from networking.tlv_parser import EncodedValue, TLVWriter
+
+_SIZE_FORMATS = {1: "B", 2: "H", 4: "I"}
+_NUMPY_FORMATS = {"B": "u1", "b": "i1", "H": "u2", "h": "i2", "I": "u4", "i": "i4"}
+
+
+class Fixed:
+    def __init__(self, fmt, pack=None, unpack=None):
+        """
+        A fixed-size value packed with a single struct.Struct call.
+
+        Formats with one field hold a scalar, formats with several hold a tuple.
+
+        Args:
+            fmt: The big-endian struct format of the value, e.g. "!HH".
+            pack: Optional conversion applied to a scalar before packing.
+            unpack: Optional conversion applied to a scalar after unpacking.
+        """
+        self.struct = struct.Struct(fmt)
+        self.format = fmt.lstrip("!")
+        self.num_fields = len(self.format.replace("x", ""))
+        self.pack = pack
+        self.unpack = unpack
+
+
+class String:
+    """A UTF-8 encoded string."""
+
+
+class Custom:
+    def __init__(self, pack, unpack):
+        """
+        A value with hand-written pack and unpack functions.
+        """
+        self.pack = pack
+        self.unpack = unpack
+
+
+class Field:
+    def __init__(self, name, tag, variant=None):
+        """
+        A named field of a Record.
+
+        Args:
+            name: The key of the field in the decoded dict.
+            tag: The tag the field is encoded with.
+            variant: Optional (flag, tag) pair, the field is encoded with the
+                alternative tag when the dict holds a truthy flag. Both tags
+                decode to the same key.
+        """
+        self.name = name
+        self.tag = tag
+        self.variant = variant
+
+
+class Record:
+    def __init__(self, *fields):
+        """
+        A container decoded into a dict, one TLV per field.
+        """
+        self.fields = fields
+
+
+class Repeated:
+    def __init__(self, tag, dtype=None, finish=None):
+        """
+        A container holding a list of TLVs with the same tag.
+
+        Args:
+            tag: The tag of the elements.
+            dtype: For Fixed elements, decode the container in bulk into a
+                NumPy array of this dtype with one row per element.
+            finish: Optional function applied to the decoded list.
+        """
+        self.tag = tag
+        self.dtype = dtype
+        self.finish = finish
+
+
+class Codec:
+    def __init__(self, tags, tag_size=2, length_size=2):
+        """
+        Builds specialized pack, unpack and write functions from a schema.
+
+        The codec holds the tag definitions of a TLVParser or a TLVWriter:
+        the tag and length sizes, and the functions of each tag from get.
+
+        Args:
+            tags: A dict mapping every tag to its type (Fixed, String, Custom,
+                Record or Repeated).
+            tag_size: The size in bytes of a tag.
+            length_size: The size in bytes of a length.
+        """
+        self.tag_size = tag_size
+        self.length_size = length_size
+        self.header_format = "!" + _SIZE_FORMATS[tag_size] + _SIZE_FORMATS[length_size]
+        self.header = struct.Struct(self.header_format)
+        self.tags = tags
+        self.tag_mappings = {}
+        # Functions decoding a value and writing a whole TLV (header included)
+        # for every tag, used by containers to skip the generic lookups
+        self.unpackers = {}
+        self.writers = {}
+
+        for tag, kind in tags.items():
+            self.tag_mappings[tag] = self.compile(tag, kind)
+            self.unpackers[tag] = self.tag_mappings[tag]["unpack_func"]
+        for tag in tags:
+            self.writers[tag] = self.compile_writer(tag)
+
+    def get(self, key, default=None):
+        return self.tag_mappings.get(key, default)
+
+    def pack_with_writer(self, write_func, value):
+        writer = TLVWriter(self, buffer_size=256)
+        write_func(writer, value)
+        return writer.getvalue()
+
+    def compile(self, tag, kind):
+        if isinstance(kind, Fixed):
+            return self.compile_fixed(kind)
+        if isinstance(kind, String):
+            return {"unpack_func": _unpack_string, "pack_func": _pack_string}
+        if isinstance(kind, Custom):
+            return {"unpack_func": kind.unpack, "pack_func": kind.pack}
+        if isinstance(kind, Record):
+            return self.compile_record(kind)
+        if isinstance(kind, Repeated):
+            return self.compile_repeated(kind)
+        raise TypeError(f"Unknown schema type for tag {tag}: {kind!r}")
+
+    def compile_writer(self, tag):
+        definition = self.tag_mappings[tag]
+        pack_func = definition["pack_func"]
+        write_func = definition.get("write_func")
+
+        if write_func is None:
+            def write(writer, value):
+                writer.write_encoded(tag, value if type(value) is EncodedValue else pack_func(value))
+        else:
+            def write(writer, value):
+                if type(value) is EncodedValue:
+                    writer.write_encoded(tag, value)
+                    return
+                writer.begin(tag)
+                write_func(writer, value)
+                writer.end()
+        return write
+
+    def compile_fixed(self, kind):
+        fmt = kind.struct
+        if kind.num_fields > 1:
+            def pack_func(value):
+                return fmt.pack(*value)
+
+            return {"unpack_func": fmt.unpack, "pack_func": pack_func}
+
+        convert_in, convert_out = kind.pack, kind.unpack or _identity
+
+        def unpack_func(data):
+            return convert_out(fmt.unpack(data)[0])
+
+        if convert_in is None:
+            pack_func = fmt.pack
+        else:
+            def pack_func(value):
+                return fmt.pack(convert_in(value))
+
+        return {"unpack_func": unpack_func, "pack_func": pack_func}
+
+    def compile_record(self, kind):
+        header = self.header
+        header_size = header.size
+        unpackers = self.unpackers
+        writers = self.writers
+        names = {}
+        for field in kind.fields:
+            names[field.tag] = field.name
+            if field.variant:
+                names[field.variant[1]] = field.name
+
+        def unpack_func(data):
+            record = {}
+            offset = 0
+            end = len(data)
+            while offset < end:
+                tag, length = _read_header(header, data, offset, end)
+                offset += header_size
+                name = names.get(tag)
+                if name is not None:
+                    record[name] = unpackers[tag](data[offset:offset + length])
+                elif tag not in unpackers:
+                    raise ValueError(f"Unknown tag: {tag}")
+                offset += length
+            return record
+
+        fields = [(field.name, field.tag, field.variant) for field in kind.fields]
+
+        def write_func(writer, value):
+            for name, tag, variant in fields:
+                if variant and value.get(variant[0]):
+                    tag = variant[1]
+                writers[tag](writer, value[name])
+
+        return {"unpack_func": unpack_func, "write_func": write_func,
+                "pack_func": lambda value: self.pack_with_writer(write_func, value)}
+
+    def compile_repeated(self, kind):
+        header = self.header
+        header_size = header.size
+        unpackers = self.unpackers
+        writers = self.writers
+        element_tag = kind.tag
+        finish = kind.finish or _identity
+        element = self.tags.get(element_tag)
+
+        def unpack_func(data):
+            values = []
+            offset = 0
+            end = len(data)
+            unpack_element = unpackers[element_tag]
+            while offset < end:
+                tag, length = _read_header(header, data, offset, end)
+                offset += header_size
+                if tag != element_tag:
+                    raise ValueError(f"Unexpected tag {tag} in a list of {element_tag}")
+                values.append(unpack_element(data[offset:offset + length]))
+                offset += length
+            return finish(values)
+
+        def write_func(writer, value):
+            write_element = writers[element_tag]
+            for item in value:
+                write_element(writer, item)
+
+        if isinstance(element, Fixed) and element.num_fields > 1:
+            unpack_func, write_func = self.compile_fixed_records(kind, element, unpack_func)
+
+        return {"unpack_func": unpack_func, "write_func": write_func,
+                "pack_func": lambda value: self.pack_with_writer(write_func, value)}
+
+    def compile_fixed_records(self, kind, element, generic_unpack_func):
+        """
+        Packs and unpacks a list of fixed-size records, header included, with
+        one struct call per record, or one NumPy call for the whole list when
+        the schema asks for an array.
+        """
+        element_tag = kind.tag
+        finish = kind.finish or _identity
+        record = struct.Struct(self.header_format + element.format)
+        record_size = record.size
+        value_size = element.struct.size
+
+        def write_func(writer, value):
+            writer.reserve(record_size * len(value))
+            buffer, position = writer.buffer, writer.position
+            for item in value:
+                record.pack_into(buffer, position, element_tag, value_size, *item)
+                position += record_size
+            writer.position = position
+
+        if kind.dtype is None:
+            def unpack_func(data):
+                if len(data) % record_size:
+                    return generic_unpack_func(data)
+                values = []
+                for tag, length, *fields in record.iter_unpack(data):
+                    if tag != element_tag or length != value_size:
+                        return generic_unpack_func(data)
+                    values.append(tuple(fields))
+                return finish(values)
+
+            return unpack_func, write_func
+
+        record_dtype = self.numpy_record_dtype(element)
+        expected_header = element_tag << (8 * self.length_size) | value_size
+        num_fields = element.num_fields
+
+        def unpack_func(data):
+            if not len(data) % record_size:
+                records = np.frombuffer(data, dtype=record_dtype)
+                if (records["header"] == expected_header).all():
+                    if "value" in record_dtype.names:
+                        return records["value"].astype(kind.dtype)
+                    values = np.empty((len(records), num_fields), dtype=kind.dtype)
+                    for i in range(num_fields):
+                        values[:, i] = records[f"f{i}"]
+                    return values
+            return np.array(generic_unpack_func(data), dtype=kind.dtype).reshape(-1, num_fields)
+
+        return unpack_func, write_func
+
+    def numpy_record_dtype(self, element):
+        fields = [("header", f">u{self.tag_size + self.length_size}")]
+        codes = element.format.lstrip("x")
+        if "x" not in codes and len(set(codes)) == 1:
+            # Leading padding and fields of a single type are viewed as one sub-array
+            padding = len(element.format) - len(codes)
+            if padding:
+                fields.append(("padding", f"V{padding}"))
+            fields.append(("value", (">" + _NUMPY_FORMATS[codes[0]], len(codes))))
+            return np.dtype(fields)
+
+        index = 0
+        for i, code in enumerate(element.format):
+            if code == "x":
+                fields.append((f"padding{i}", "V1"))
+            else:
+                fields.append((f"f{index}", ">" + _NUMPY_FORMATS[code]))
+                index += 1
+        return np.dtype(fields)
+
+
+def _read_header(header, data, offset, end):
+    if end < offset + header.size:
+        raise ValueError("Incomplete data: Tag or length missing")
+    tag, length = header.unpack_from(data, offset)
+    if end < offset + header.size + length:
+        raise ValueError(f"Incomplete data: Value length {length} exceeds remaining data {end}")
+    return tag, length
+
+
+def _identity(value):
+    return value
+
+
+def _unpack_string(data):
+    return str(data, "utf-8")
+
+
+def _pack_string(value):
+    return value.encode()
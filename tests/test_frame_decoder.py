@@ -0,0 +1,86 @@
+import socket
+
+import pytest
+
+from networking.frame_decoder import FrameDecoder
+
+
+def encode_frame(payload, length_size=2):
+    return (len(payload) + length_size).to_bytes(length_size, byteorder="big") + payload
+
+
+def test_whole_frames():
+    decoder = FrameDecoder()
+
+    assert decoder.feed(encode_frame(b"one") + encode_frame(b"two")) == [b"one", b"two"]
+    assert not decoder.has_partial_frame()
+
+
+def test_partial_frames_byte_by_byte():
+    decoder = FrameDecoder()
+    data = encode_frame(b"hello") + encode_frame(b"world")
+
+    frames = []
+    for i in range(len(data)):
+        frames += decoder.feed(data[i:i + 1])
+        assert decoder.has_partial_frame() == (i + 1 not in (7, len(data)))
+
+    assert frames == [b"hello", b"world"]
+
+
+def test_frame_split_across_reads():
+    decoder = FrameDecoder()
+    data = encode_frame(b"first") + encode_frame(b"second")
+
+    assert decoder.feed(data[:10]) == [b"first"]
+    assert decoder.has_partial_frame()
+    assert decoder.feed(data[10:]) == [b"second"]
+
+
+def test_frame_larger_than_the_buffer():
+    decoder = FrameDecoder(buffer_size=16)
+    payload = bytes(range(256)) * 40
+
+    assert decoder.feed(encode_frame(payload)[:100]) == []
+    assert len(decoder.buffer) >= len(payload) + 2
+    assert decoder.feed(encode_frame(payload)[100:] + encode_frame(b"next")) == [payload, b"next"]
+
+
+def test_partial_frame_kept_when_the_buffer_grows():
+    decoder = FrameDecoder(buffer_size=16)
+    data = encode_frame(b"a" * 10) + encode_frame(b"b" * 40)
+
+    assert decoder.feed(data[:20]) == [b"a" * 10]
+    assert decoder.feed(data[20:]) == [b"b" * 40]
+
+
+def test_four_byte_length_prefix():
+    decoder = FrameDecoder(length_size=4)
+
+    assert decoder.feed(encode_frame(b"payload", length_size=4)) == [b"payload"]
+
+
+@pytest.mark.parametrize("length", [0, 1])
+def test_length_prefix_shorter_than_itself(length):
+    decoder = FrameDecoder()
+
+    with pytest.raises(ValueError, match="Invalid frame length"):
+        decoder.feed(length.to_bytes(2, byteorder="big") + b"rest")
+
+
+def test_empty_frame():
+    assert FrameDecoder().feed(encode_frame(b"")) == [b""]
+
+
+def test_recv_from_until_closed():
+    decoder = FrameDecoder(buffer_size=4)
+    ours, theirs = socket.socketpair()
+    with ours, theirs:
+        theirs.sendall(encode_frame(b"over the socket"))
+        frames = []
+        while len(frames) < 1:
+            frames += decoder.recv_from(ours)
+        theirs.close()
+
+        assert frames == [b"over the socket"]
+        assert decoder.recv_from(ours) is None
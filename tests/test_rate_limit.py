@@ -0,0 +1,69 @@
+import pytest
+
+from networking.server import rate_limit
+from networking.server.rate_limit import RateLimiter
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(rate_limit.time, "monotonic", lambda: now[0])
+    return now
+
+
+def test_burst_then_empty(clock):
+    limiter = RateLimiter(rate=1.0, burst=3)
+
+    assert [limiter.allow("ip") for _ in range(4)] == [True, True, True, False]
+
+
+def test_tokens_refill_at_rate(clock):
+    limiter = RateLimiter(rate=2.0, burst=3)
+    for _ in range(3):
+        limiter.allow("ip")
+
+    clock[0] += 0.25
+    assert not limiter.allow("ip")
+    clock[0] += 0.25
+    assert limiter.allow("ip")
+    assert not limiter.allow("ip")
+
+
+def test_refill_is_capped_at_burst(clock):
+    limiter = RateLimiter(rate=10.0, burst=2)
+    limiter.allow("ip")
+
+    clock[0] += 60
+    assert [limiter.allow("ip") for _ in range(3)] == [True, True, False]
+
+
+def test_rejected_attempts_take_no_token(clock):
+    limiter = RateLimiter(rate=1.0, burst=1)
+    limiter.allow("ip")
+    for _ in range(5):
+        assert not limiter.allow("ip")
+
+    clock[0] += 1
+    assert limiter.allow("ip")
+
+
+def test_keys_have_their_own_bucket(clock):
+    limiter = RateLimiter(rate=1.0, burst=1)
+
+    assert limiter.allow("alice")
+    assert limiter.allow("bob")
+    assert not limiter.allow("alice")
+
+
+def test_least_recently_used_keys_are_forgotten(clock):
+    limiter = RateLimiter(rate=1.0, burst=1, max_keys=2)
+    limiter.allow("a")
+    limiter.allow("b")
+    limiter.allow("a")
+    limiter.allow("c")
+
+    assert list(limiter.buckets) == ["a", "c"]
+    # Forgetting a bucket refills it
+    assert limiter.allow("b")
+    assert list(limiter.buckets) == ["c", "b"]
+    assert not limiter.allow("c")
@@ -0,0 +1,103 @@
+import struct
+
+import pytest
+
+from networking import config, tlv_definitions
+from networking.tlv_parser import TLVWriter
+
+parser = tlv_definitions.parser
+ROOM = {
+    "id": "room1",
+    "current_players": 2,
+    "max_players": 4,
+    "state": 0x5001,
+    "players": ["alice", "bob"],
+    "round": 1,
+    "num_rounds": 5,
+    "min_players": 2,
+    "owner": "alice",
+}
+
+
+def frame(packet):
+    # Received frames come without their length prefix
+    return packet[tlv_definitions.tag_definitions.length_size:]
+
+
+def test_parse_packet_roundtrip():
+    packet = parser.encode_tlv_packet(config.RESPONSE_JOIN_ROOM_RESULT, [
+        (config.TAG_SUCCESS, True),
+        (config.TAG_ROOM, ROOM),
+    ])
+
+    assert parser.parse_packet(frame(packet)) == (config.RESPONSE_JOIN_ROOM_RESULT, [True, ROOM])
+
+
+def test_parse_packet_from_a_view_into_a_larger_buffer():
+    packet = parser.encode_tlv_packet(config.RESPONSE_LIST_ROOMS_RESULT, [(config.TAG_ROOMS, [ROOM, ROOM])])
+    buffer = bytearray(b"\xff" * 3 + frame(packet) + b"\xff" * 3)
+
+    with memoryview(buffer) as view:
+        packet_id, fields = parser.parse_packet(view[3:-3])
+
+    assert packet_id == config.RESPONSE_LIST_ROOMS_RESULT
+    assert fields == [[ROOM, ROOM]]
+
+
+def test_read_tlv_rejects_truncated_values():
+    data = frame(parser.encode_tlv_packet(config.RESPONSE_ERROR, [(config.TAG_ERROR_MESSAGE, "Server busy")]))
+
+    with pytest.raises(ValueError, match="exceeds remaining data"):
+        parser.parse_packet(data[:-1])
+    with pytest.raises(ValueError, match="Tag or length missing"):
+        parser.parse_packet(data[:tlv_definitions.tag_definitions.tag_size + 1])
+
+
+def test_read_tlv_rejects_unknown_tags():
+    data = b"\x00\x01" + b"\xfe\xfe\x00\x00"
+
+    with pytest.raises(ValueError, match="Unknown tag"):
+        parser.parse_packet(data)
+
+
+def test_writer_patches_nested_lengths():
+    writer = TLVWriter(tlv_definitions.tag_definitions, buffer_size=8)
+    writer.begin_packet(config.RESPONSE_ERROR)
+    writer.begin(config.TAG_ROOMS)
+    writer.begin(config.TAG_ROOM)
+    writer.write_encoded(config.TAG_ROOM_ID, b"r1")
+    writer.end()
+    writer.end()
+    writer.end()
+    packet = writer.getvalue()
+
+    # length, packet id, TAG_ROOMS header, TAG_ROOM header, TAG_ROOM_ID header and value
+    assert len(packet) == 2 + 2 + 4 + 4 + 4 + 2
+    assert struct.unpack_from("!H", packet, 0)[0] == len(packet)
+    assert struct.unpack_from("!HH", packet, 4) == (config.TAG_ROOMS, 10)
+    assert struct.unpack_from("!HH", packet, 8) == (config.TAG_ROOM, 6)
+    assert struct.unpack_from("!HH", packet, 12) == (config.TAG_ROOM_ID, 2)
+
+
+def test_writer_packet_roundtrip_with_a_small_buffer():
+    writer = TLVWriter(tlv_definitions.tag_definitions, buffer_size=4)
+    rooms = [dict(ROOM, id=f"room{i}") for i in range(20)]
+
+    packet = writer.write_packet(config.RESPONSE_LIST_ROOMS_RESULT, [(config.TAG_ROOMS, rooms)])
+
+    assert struct.unpack_from("!H", packet, 0)[0] == len(packet)
+    assert parser.parse_packet(frame(packet)) == (config.RESPONSE_LIST_ROOMS_RESULT, [rooms])
+    # The buffer is reused for the next packet
+    assert writer.write_packet(config.RESPONSE_REGISTER_RESULT, [(config.TAG_SUCCESS, True)]) == \
+        parser.encode_tlv_packet(config.RESPONSE_REGISTER_RESULT, [(config.TAG_SUCCESS, True)])
+
+
+def test_writer_rejects_containers_longer_than_the_length_field():
+    writer = TLVWriter(tlv_definitions.tag_definitions)
+    writer.reset()
+    writer.begin(config.TAG_PLAYERS)
+    for i in range(8000):
+        writer.write_encoded(config.TAG_USERNAME, b"player%d" % i)
+
+    with pytest.raises(ValueError, match="does not fit in the length field"):
+        writer.end()
@@ -0,0 +1,154 @@
+import struct
+
+import numpy as np
+import pytest
+
+from networking import config, tlv_definitions
+from networking.tlv_parser import EncodedValue, TLVParser
+from networking.tlv_schema import Codec, Field, Fixed, Record, Repeated, String
+
+ROOM = {
+    "id": "room1",
+    "current_players": 1,
+    "max_players": 4,
+    "state": 0x5001,
+    "players": ["alice"],
+    "round": 0,
+    "num_rounds": 5,
+    "min_players": 2,
+    "owner": "alice",
+}
+
+LIST, RECORD, NAME, ITEM, ITEMS, PAIR, PAIRS = range(1, 8)
+codec = Codec({
+    LIST: Repeated(ITEM, dtype=np.int64),
+    ITEM: Fixed("!BI"),
+    ITEMS: Repeated(ITEM),
+    PAIR: Fixed("!hh"),
+    PAIRS: Repeated(PAIR, dtype=np.int16),
+    RECORD: Record(Field("name", NAME), Field("items", ITEMS)),
+    NAME: String(),
+})
+
+
+def pack(tag, value, definitions=codec):
+    return definitions.get(tag)["pack_func"](value)
+
+
+def unpack(tag, data, definitions=codec):
+    return definitions.get(tag)["unpack_func"](data)
+
+
+def test_record_roundtrip():
+    value = {"name": "crates", "items": [(1, 2), (255, 2 ** 32 - 1)]}
+
+    assert unpack(RECORD, pack(RECORD, value)) == value
+
+
+def test_record_skips_unknown_fields_of_known_tags():
+    data = pack(RECORD, {"name": "crates", "items": []}) + struct.pack("!HH", PAIR, 4) + struct.pack("!hh", 1, 2)
+
+    assert unpack(RECORD, data) == {"name": "crates", "items": []}
+
+
+def test_room_roundtrip():
+    assert tlv_definitions.unpack_value(config.TAG_ROOM, tlv_definitions.pack_value(config.TAG_ROOM, ROOM)) == ROOM
+
+
+def test_fixed_records_without_dtype_decode_to_tuples():
+    assert unpack(ITEMS, pack(ITEMS, [(1, 2), (3, 4)])) == [(1, 2), (3, 4)]
+
+
+def test_fixed_records_match_the_generic_encoding():
+    # One TLV per element, as a generic writer would encode them
+    data = b"".join(struct.pack("!HHBI", ITEM, 5, a, b) for a, b in [(1, 2), (3, 4)])
+
+    assert pack(ITEMS, [(1, 2), (3, 4)]) == data
+
+
+def test_numpy_records_of_mixed_fields():
+    values = unpack(LIST, pack(LIST, [(1, 2), (255, 2 ** 32 - 1)]))
+
+    assert values.dtype == np.int64
+    assert values.tolist() == [[1, 2], [255, 2 ** 32 - 1]]
+
+
+def test_numpy_records_of_one_field_type():
+    values = unpack(PAIRS, pack(PAIRS, [(1, -2), (-300, 400)]))
+
+    assert values.dtype == np.int16
+    assert values.tolist() == [[1, -2], [-300, 400]]
+
+
+def test_numpy_records_with_padding():
+    colours = [(255, 0, 16), (1, 2, 3)]
+    data = tlv_definitions.pack_value(config.TAG_COLOURS, colours)
+
+    assert data[4:8] == b"\x00\xff\x00\x10"
+    values = tlv_definitions.unpack_value(config.TAG_COLOURS, data)
+    assert values.dtype == np.uint8
+    assert values.tolist() == [list(colour) for colour in colours]
+
+
+def test_numpy_records_empty():
+    values = unpack(PAIRS, b"")
+
+    assert values.shape == (0, 2)
+
+
+def test_mismatched_record_tag_falls_back_to_generic_decoding():
+    data = bytearray(pack(PAIRS, [(1, 2), (3, 4)]))
+    struct.pack_into("!H", data, 8, ITEM)
+
+    with pytest.raises(ValueError, match=f"Unexpected tag {ITEM}"):
+        unpack(PAIRS, bytes(data))
+    data = bytearray(pack(ITEMS, [(1, 2), (3, 4)]))
+    struct.pack_into("!H", data, 9, PAIR)
+    with pytest.raises(ValueError, match=f"Unexpected tag {PAIR}"):
+        unpack(ITEMS, bytes(data))
+
+
+def test_mismatched_record_length_falls_back_to_generic_decoding():
+    # A record split as a 2 byte element and a 6 byte one has the size of two regular records
+    data = struct.pack("!HHh", PAIR, 2, 1) + struct.pack("!HHhhh", PAIR, 6, 1, 2, 3)
+
+    with pytest.raises(struct.error):
+        unpack(PAIRS, data)
+
+
+def test_truncated_records_fall_back_to_generic_decoding():
+    data = pack(PAIRS, [(1, 2), (3, 4)])[:-1]
+
+    with pytest.raises(ValueError, match="Incomplete data"):
+        unpack(PAIRS, data)
+
+
+def test_game_info_map_variants():
+    maze = np.array([[1, 1, 1], [1, 0, 2], [1, 1, 1]], dtype=np.int8)
+    game_info = {
+        "map": maze.tolist(),
+        "player_colours": [(1, 2, 3)],
+        "map_colours": [(4, 5, 6), (7, 8, 9), (10, 11, 12)],
+        "player_positions": [(1, 1)],
+    }
+
+    for packed_map in (False, True):
+        data = tlv_definitions.pack_value(config.TAG_GAME_INFO, dict(game_info, packed_map=packed_map))
+        decoded = tlv_definitions.unpack_value(config.TAG_GAME_INFO, data)
+
+        assert np.array_equal(decoded["map"], maze)
+        assert decoded["player_positions"].tolist() == [[1, 1]]
+        assert decoded["map_colours"].tolist() == [[4, 5, 6], [7, 8, 9], [10, 11, 12]]
+
+
+def test_encoded_values_are_written_as_is():
+    parser = TLVParser(codec)
+    encoded = EncodedValue(pack(RECORD, {"name": "cached", "items": [(1, 2)]}))
+
+    assert parser.encode_tlv_packet(1, [(RECORD, encoded)]) == \
+        parser.encode_tlv_packet(1, [(RECORD, {"name": "cached", "items": [(1, 2)]})])
+
+
+def test_unknown_schema_type():
+    with pytest.raises(TypeError, match="Unknown schema type"):
+        Codec({1: object()})